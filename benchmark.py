@@ -0,0 +1,158 @@
+"""Times stimulus and config generation over a grid of parameters.
+
+Each stage is run on synthetic shape libraries with n_part left and right
+parts, so it can be scaled beyond the libraries in stimuli/. Results are
+saved as json (by default to benchmarks/<commit>.json) so that runs on
+different commits can be compared with --compare.
+
+    python benchmark.py
+    python benchmark.py --quick --compare benchmarks/abc1234.json
+"""
+import os
+import json
+import time
+import random
+import tempfile
+import platform
+import subprocess
+import tracemalloc
+from itertools import product
+
+import numpy as np
+
+from stimuli import Shapes, Codes
+from generate_configs import InformativeTrials, generate_config, INSTRUCT_SHAPES, MAX_DIGIT, CODE_LENGTH
+
+GRID = {
+    'n_part': [3, 5, 8],
+    'max_digit': [5, 9],
+    'code_length': [4, 6],
+}
+QUICK_GRID = {
+    'n_part': [5],
+    'max_digit': [9],
+    'code_length': [4],
+}
+
+def synthetic_shapes(n_part, width=8, height=5, seed=0):
+    """Writes a random shape library with n_part left and right parts; returns the file name.
+
+    Left parts only use the left half of the grid and right parts the right
+    half, so every composition is valid.
+    """
+    rng = np.random.default_rng(seed)
+    half = width // 2
+    def parts(value, cols):
+        grids = np.zeros((n_part, height, width), dtype=int)
+        grids[:, :, cols] = value * (rng.random((n_part, height, cols.stop - cols.start)) < .5)
+        grids[:, height // 2, cols] = value  # never empty
+        return grids.tolist()
+    fd, file = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'left': parts(1, slice(0, half)), 'right': parts(2, slice(half, width))}, f)
+    return file
+
+def measure(fn, min_time=0.5, max_iter=10_000):
+    """Mean seconds per call (repeating until min_time has passed) and peak traced memory of one call."""
+    fn()  # warm up
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    n = 0
+    start = time.perf_counter()
+    while True:
+        fn()
+        n += 1
+        elapsed = time.perf_counter() - start
+        if elapsed > min_time or n >= max_iter:
+            return elapsed / n, peak
+
+def stages(n_part, max_digit, code_length):
+    """The stages to time for one point in the grid, as (name, function) pairs."""
+    shapes_file = synthetic_shapes(n_part)
+    shapes = Shapes(shapes_file)
+    instruct_shapes = Shapes(INSTRUCT_SHAPES)
+    tasks = [f'{i+1}{j+1}' for i, j in product(range(n_part), repeat=2)]
+
+    def all_codes():
+        codes = Codes(max_digit, code_length)
+        for task in tasks:
+            codes.get(task, 'compositional')
+            codes.get(task, 'bespoke')
+
+    yield 'shapes', lambda: Shapes(shapes_file)
+    yield 'codes', all_codes
+    yield 'trials', lambda: InformativeTrials(shapes, max_digit, code_length).generate()
+    # generate_config always uses the configured MAX_DIGIT and CODE_LENGTH
+    if (max_digit, code_length) == (MAX_DIGIT, CODE_LENGTH):
+        i = iter(range(10 ** 9))
+        yield 'config', lambda: generate_config(next(i), shapes, instruct_shapes)
+    os.remove(shapes_file)
+
+def run(grid, min_time=0.5):
+    results = []
+    for n_part, max_digit, code_length in product(grid['n_part'], grid['max_digit'], grid['code_length']):
+        params = {'n_part': n_part, 'max_digit': max_digit, 'code_length': code_length}
+        random.seed(0)
+        for stage, fn in stages(**params):
+            try:
+                seconds, peak = measure(fn, min_time)
+            except ValueError as e:  # e.g. too few tasks for the number of manual entries
+                print(f'{stage:8} {params}  infeasible: {e}')
+                results.append({'stage': stage, **params, 'error': str(e)})
+                continue
+            result = {'stage': stage, **params, 'seconds': seconds, 'per_sec': 1 / seconds, 'peak_kb': peak / 1024}
+            print(f'{stage:8} {params}  {1000 * seconds:8.3f} ms  {1 / seconds:10.1f}/s  {peak / 1024:8.1f} kB peak')
+            results.append(result)
+    return results
+
+def key(r):
+    return (r['stage'], r['n_part'], r['max_digit'], r['code_length'])
+
+def compare(results, baseline):
+    """Prints the speedup of each result relative to a saved run."""
+    base = {key(r): r for r in baseline['results'] if 'seconds' in r}
+    print(f"\ncompared to {baseline['commit']}:")
+    for r in results:
+        if 'seconds' in r and key(r) in base:
+            speedup = base[key(r)]['seconds'] / r['seconds']
+            flag = '  <-- slower' if speedup < 0.9 else ''
+            print(f"{r['stage']:8} n_part={r['n_part']} max_digit={r['max_digit']} code_length={r['code_length']}  {speedup:6.2f}x{flag}")
+
+def git_commit():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no']).strip()
+        return commit + ('-dirty' if dirty else '')
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return 'unknown'
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--quick", help="Only run the default parameters", action="store_true")
+    parser.add_argument("--min-time", help="Seconds to spend timing each stage", type=float, default=0.5)
+    parser.add_argument("-o", "--out", help="Where to save results (default: benchmarks/<commit>.json)")
+    parser.add_argument("--compare", help="A saved result file to compare against")
+    args = parser.parse_args()
+
+    commit = git_commit()
+    results = run(QUICK_GRID if args.quick else GRID, args.min_time)
+    out = args.out or f'benchmarks/{commit}.json'
+    os.makedirs(os.path.dirname(out) or '.', exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump({
+            'commit': commit,
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'results': results,
+        }, f, indent=2)
+    print(f'wrote {out}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
@@ -1,23 +1,113 @@
 #!/usr/bin/env python3
 import pandas as pd
 import os
+import configparser
 from fire import Fire
 
-def main(codeversion):
-    qd = pd.read_csv(f'data/human_raw/{codeversion}/questiondata.csv', header=None)
-    x = qd.loc[qd[1] == 'bonus']
-    bonus = pd.DataFrame({
-        'participant_id': x[0].apply(lambda x: x.split(':')[0]),
-        'bonus': x[2].astype(float)
-    }).set_index('participant_id').bonus
+def bonus_per_solution():
+    """The bonus in dollars for each solved puzzle, from config.txt (as in custom.py)."""
+    c = configparser.ConfigParser()
+    c.read('config.txt')
+    return c.getfloat('Task Parameters', 'bonus_per_solution')
 
-    file = f'data/human_raw/{codeversion}/bonus.csv'
-    bonus.to_csv(file, index=True, header=False)
+SOLVED = ['compositional', 'bespoke']
+
+def load_events(version, columns):
+    """The event store written by fetch_data.py --columnar, built from the events files if needed.
+
+    The store is rebuilt if it is missing or older than participants.csv or
+    any events file, i.e. if fetch_data.py has run since without --columnar.
+    """
+    import pyarrow as pa
+    file = f'data/raw/{version}/events.arrow'
+    wids = pd.read_csv(f'data/raw/{version}/participants.csv').wid
+    sources = [f'data/raw/{version}/participants.csv'] + [f'data/raw/{version}/events/{wid}.json' for wid in wids]
+    if not os.path.isfile(file) or os.path.getmtime(file) < max(map(os.path.getmtime, sources)):
+        from fetch_data import write_event_store
+        os.makedirs(f'data/raw/{version}/columns', exist_ok=True)
+        write_event_store(version, wids)
+    return pa.ipc.open_file(pa.memory_map(file)).read_all().select(columns)
+
+def count_solutions(version):
+    """Number of main puzzles each participant (by wid) solved, compositionally or bespoke.
+
+    Instruction puzzles also emit machine.done, so we only count those after
+    experiment.main.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    table = load_events(version, ['wid', 'index', 'event', 'info'])
+    event = pc.cast(table['event'], pa.string())
+    table = table.filter(pc.is_in(event, pa.array(['experiment.main', 'machine.done'])))
+    df = table.to_pandas()
+    df['wid'] = df.wid.astype(str)
+    df['event'] = df.event.astype(str)
+
+    main_start = df.loc[df.event == 'experiment.main'].groupby('wid')['index'].min()
+    done = df.loc[df.event == 'machine.done']
+    done = done.loc[done['index'] > done.wid.map(main_start)]  # no experiment.main -> NaN -> False
+    kind = done['info'].str.extract(r'"solutionType":\s*"(\w+)"', expand=False)
+    return done.loc[kind.isin(SOLVED)].groupby('wid').size()
+
+def compute_bonuses(*codeversions):
+    """Bonus in dollars for each Prolific participant id, summed over codeversions."""
+    bonuses = []
+    rate = bonus_per_solution()
+    for version in codeversions:
+        wids = pd.read_csv(f'data/raw/{version}/participants.csv').set_index('wid').workerid
+        n_solved = count_solutions(version)
+        bonuses.append((rate * n_solved).rename(index=wids))
+    bonus = pd.concat(bonuses).groupby(level=0).sum().round(2)
+    bonus.index.name = 'participant_id'
+    return bonus[bonus > 0].rename('bonus')
+
+def paid_bonuses(n):
+    """Bonuses already paid (in dollars) to each participant across the last n Prolific studies."""
+    from prolific import Prolific
+    prolific = Prolific()
+    study_ids = [prolific.study_id(i) for i in range(min(n, len(prolific._studies())))]
+    submissions = prolific._all_submissions(study_ids)
+    paid = pd.DataFrame(
+        [(sub['participant_id'], sum(sub['bonus_payments'])) for subs in submissions.values() for sub in subs],
+        columns=['participant_id', 'paid']
+    )
+    return (paid.groupby('participant_id').paid.sum() / 100).round(2)
+
+def csv_bonuses(bonus):
+    """The csv_bonuses payload for Prolific's bonus-payments endpoint."""
+    return '\n'.join(f'{p},{b:.2f}' for p, b in bonus.items())
+
+def main(*codeversions, out='bonus.csv', n=None, pay=False):
+    """Computes bonuses for codeversions from the event store and writes them to out.
+
+    out has one participant_id,bonus line per participant, which is what
+    bin/prolific.py pay/pay_all/assign_bonuses read (they only pay the
+    difference from what each participant has already received).
+
+    With --n, also fetches what has already been paid across the last n
+    studies and prints the csv_bonuses payload for what is still owed.
+    With --pay, goes on to pay that through Prolific.pay_all (implies --n 10).
+    """
+    bonus = compute_bonuses(*codeversions)
+    bonus.to_csv(out, index=True, header=False)
     print(len(bonus), 'participants to receive bonuses')
-    print(f'mean: ${bonus.mean():.2f}  median: ${bonus.median():.2f}')
+    print(f'mean: ${bonus.mean():.2f}  median: ${bonus.median():.2f}  total: ${bonus.sum():.2f}')
+    print(f'Wrote {out}')
+
+    if pay and n is None:
+        n = 10
+    if n is None:
+        return
+
+    paid = paid_bonuses(n).reindex(bonus.index, fill_value=0)
+    due = (bonus - paid).round(2)
+    due = due[due > 0]
+    print(f'\n{len(due)} participants still owed ${due.sum():.2f}')
+    print(csv_bonuses(due))
 
-    os.system(f'cat {file} | pbcopy')
-    print(f'Wrote {file} and copied contents to clipboard.')
+    if pay and len(due):
+        from prolific import Prolific
+        Prolific().pay_all(n, bonuses=bonus.to_dict(), approve=False)
 
 if __name__ == '__main__':
     Fire(main)
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""A local stand-in for the Prolific API, for load and regression testing bin/prolific.py
+
+Serves a synthetic project with many studies and submissions, supporting the
+endpoints that bin/prolific.py uses, including paging. It can also inject
+latency and rate limiting (429) errors. Run it and then point the client at it:
+
+    bin/fake_prolific.py --studies 500 --submissions 200 --latency 0.05 --error-rate 0.05
+    PROLIFIC_API_URL=http://localhost:5001/api/v1 PROLIFIC_TOKEN=fake bin/prolific.py summary_csv --stats
+
+Every project id refers to the same synthetic project.
+"""
+import random
+import threading
+import time
+import hashlib
+import json
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from datetime import datetime, timedelta, timezone
+from flask import Flask, request, jsonify, abort, Response
+
+app = Flask(__name__)
+app.url_map.strict_slashes = False
+lock = threading.Lock()
+studies = {}  # id -> study
+submissions = {}  # study id -> list of submissions
+bonus_payments = {}  # id -> {'study_id', 'bonuses', 'total_amount', 'paid'}
+options = {'latency': 0, 'error_rate': 0, 'max_page': 100}
+
+COMPLETION_CODE = 'CH2Q1VIL'
+
+
+def new_id():
+    return '%024x' % random.getrandbits(96)
+
+
+def make_submission(study, i):
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=random.randrange(100000))
+    minutes = random.lognormvariate(2.7, 0.4)
+    complete = random.random() < 0.9
+    return {
+        'id': new_id(),
+        'participant_id': new_id(),
+        'status': random.choice(['AWAITING REVIEW', 'APPROVED']) if complete else 'RETURNED',
+        'study_code': COMPLETION_CODE if random.random() < 0.97 else 'NOCODE',
+        'started_at': start.isoformat(),
+        'completed_at': (start + timedelta(minutes=minutes)).isoformat() if complete else None,
+        'time_taken': round(minutes * 60) if complete else None,
+        'is_complete': complete,
+        'bonus_payments': [],
+        'ip': '127.0.0.1',
+    }
+
+
+def make_project(n_study, n_submission):
+    for i in range(n_study):
+        study = {
+            'id': new_id(),
+            'name': 'Code Cracker',
+            'internal_name': f'machine fake-{i}',
+            'status': 'COMPLETED' if i < n_study - 2 else 'ACTIVE',
+            'reward': 300,
+            'total_available_places': n_submission,
+            'total_cost': 300 * n_submission * 4 // 3,
+            'description': '',
+            'external_study_url': 'http://localhost/?PROLIFIC_PID={{%PROLIFIC_PID%}}&STUDY_ID={{%STUDY_ID%}}&SESSION_ID={{%SESSION_ID%}}',
+            'completion_codes': [{'code': COMPLETION_CODE, 'code_type': 'COMPLETED'}],
+        }
+        studies[study['id']] = study
+        submissions[study['id']] = [make_submission(study, j) for j in range(n_submission)]
+
+
+@app.before_request
+def inject_faults():
+    if request.headers.get('Authorization', '').split(' ')[0] != 'Token':
+        abort(401)
+    if options['latency']:
+        time.sleep(random.expovariate(1 / options['latency']))
+    if random.random() < options['error_rate']:
+        return jsonify({'error': 'rate limited'}), 429, {'Retry-After': '1'}
+
+
+def paginate(items):
+    """Prolific style paging with limit/offset and a _links.next href. Supports ETags."""
+    limit = min(int(request.args.get('limit', options['max_page'])), options['max_page'])
+    offset = int(request.args.get('offset', 0))
+    page = items[offset:offset + limit]
+    next_href = None
+    if offset + limit < len(items):
+        args = {**request.args, 'limit': limit, 'offset': offset + limit}
+        next_href = request.base_url + '?' + '&'.join(f'{k}={v}' for k, v in args.items())
+    body = json.dumps({
+        'results': page,
+        '_links': {'next': {'href': next_href, 'title': 'Next'}},
+        'meta': {'count': len(items)},
+    })
+    etag = '"%s"' % hashlib.md5(body.encode()).hexdigest()
+    if request.headers.get('If-None-Match') == etag:
+        return Response(status=304, headers={'ETag': etag})
+    return Response(body, content_type='application/json', headers={'ETag': etag})
+
+
+@app.route('/api/v1/projects/<project_id>/studies', methods=['GET'])
+def list_studies(project_id):
+    states = request.args.get('state', '').strip('()').upper().split('|')
+    with lock:
+        items = [s for s in studies.values() if not states[0] or s['status'] in states]
+    return paginate(items)
+
+
+@app.route('/api/v1/studies/<study_id>', methods=['GET', 'PATCH', 'DELETE'])
+def study(study_id):
+    with lock:
+        if study_id not in studies:
+            abort(404)
+        if request.method == 'PATCH':
+            studies[study_id].update(request.get_json())
+        elif request.method == 'DELETE':
+            del studies[study_id]
+            return '', 204
+        return jsonify(studies[study_id])
+
+
+@app.route('/api/v1/studies/<study_id>/clone', methods=['POST'])
+def clone(study_id):
+    with lock:
+        new = {**studies[study_id], 'id': new_id(), 'status': 'UNPUBLISHED'}
+        new['name'] += ' Copy'
+        studies[new['id']] = new
+        submissions[new['id']] = []
+    return jsonify(new)
+
+
+@app.route('/api/v1/studies/<study_id>/transition', methods=['POST'])
+def transition(study_id):
+    status = {'PAUSE': 'PAUSED', 'START': 'ACTIVE', 'PUBLISH': 'ACTIVE'}[request.get_json()['action']]
+    with lock:
+        studies[study_id]['status'] = status
+    return jsonify(studies[study_id])
+
+
+@app.route('/api/v1/studies/<study_id>/submissions', methods=['GET'])
+def list_submissions(study_id):
+    with lock:
+        items = list(submissions.get(study_id, []))
+    return paginate(items)
+
+
+@app.route('/api/v1/submissions/bulk-approve', methods=['POST'])
+def bulk_approve():
+    data = request.get_json()
+    ids = set(data['participant_ids'])
+    with lock:
+        for sub in submissions[data['study_id']]:
+            if sub['participant_id'] in ids and sub['status'] == 'AWAITING REVIEW':
+                sub['status'] = 'APPROVED'
+    return jsonify({})
+
+
+@app.route('/api/v1/submissions/bonus-payments', methods=['POST'])
+def setup_bonus():
+    data = request.get_json()
+    bonuses = {}
+    for line in data['csv_bonuses'].strip().split('\n'):
+        pid, amount = line.split(',')
+        bonuses[pid] = round(float(amount) * 100)
+    payment = {
+        'id': new_id(),
+        'study_id': data['study_id'],
+        'bonuses': bonuses,
+        'total_amount': round(sum(bonuses.values()) * 4 / 3),  # including fees
+        'paid': False,
+    }
+    with lock:
+        bonus_payments[payment['id']] = payment
+    return jsonify({k: payment[k] for k in ['id', 'study_id', 'total_amount']})
+
+
+@app.route('/api/v1/bulk-bonus-payments/<payment_id>/pay', methods=['POST'])
+def pay_bonus(payment_id):
+    with lock:
+        payment = bonus_payments[payment_id]
+        if payment['paid']:
+            return jsonify({'error': 'already paid'}), 400
+        payment['paid'] = True
+        for sub in submissions[payment['study_id']]:
+            if sub['participant_id'] in payment['bonuses']:
+                sub['bonus_payments'].append(payment['bonuses'][sub['participant_id']])
+    return jsonify({})
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--port", type=int, default=5001)
+    parser.add_argument("--studies", help="Number of studies in the project", type=int, default=100)
+    parser.add_argument("--submissions", help="Number of submissions per study", type=int, default=100)
+    parser.add_argument("--latency", help="Mean added latency per request (seconds)", type=float, default=0)
+    parser.add_argument("--error-rate", help="Fraction of requests that get a 429", type=float, default=0)
+    parser.add_argument("--max-page", help="Maximum page size for listings", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    options.update(latency=args.latency, error_rate=args.error_rate, max_page=args.max_page)
+    make_project(args.studies, args.submissions)
+    print(f'Serving {args.studies} studies with {args.submissions} submissions each')
+    print(f'PROLIFIC_API_URL=http://localhost:{args.port}/api/v1')
+    app.run(port=args.port, threaded=True)
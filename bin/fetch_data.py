@@ -5,6 +5,7 @@ import subprocess
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 import hashlib
 import json
+from functools import partial
 
 # set environment parameters so that we use the remote database
 
@@ -46,7 +47,125 @@ def write_csv(file, records):
         for record in records:
             writer.writerow(record)
 
-def write_data(version, mode):
+METAKEYS = ['condition', 'useragent']
+EVENT_COLUMNS = ['event', 'time', 'trialID', 'task', 'code']
+
+def write_event_columns(file, wid, trialdata):
+    """Writes one participant's events as an Arrow table.
+
+    The common fields get their own typed column; everything else is kept as
+    a JSON string in the info column.
+    """
+    import pyarrow as pa
+    string = lambda x: None if x is None else str(x)
+    columns = {
+        'wid': pa.array([wid] * len(trialdata)).dictionary_encode(),
+        'index': pa.array(range(len(trialdata)), pa.int32()),
+        'event': pa.array([e['event'] for e in trialdata], pa.string()).dictionary_encode(),
+        'time': pa.array([e.get('time') for e in trialdata], pa.int64()),
+        'trialID': pa.array([string(e.get('trialID')) for e in trialdata], pa.string()),
+        'task': pa.array([string(e.get('task')) for e in trialdata], pa.string()),
+        'code': pa.array([string(e.get('code')) for e in trialdata], pa.string()),
+        'info': pa.array([
+            json.dumps({k: v for k, v in e.items() if k not in EVENT_COLUMNS})
+            for e in trialdata
+        ], pa.string()),
+    }
+    with pa.OSFile(file, 'wb') as sink, pa.ipc.new_file(sink, pa.schema({k: v.type for k, v in columns.items()})) as writer:
+        writer.write_table(pa.table(columns))
+
+def write_event_store(version, wids):
+    """Concatenates the per-participant event tables into data/raw/<version>/events.arrow.
+
+    The result is an uncompressed Arrow IPC file, so it can be memory-mapped, e.g.
+        pa.ipc.open_file(pa.memory_map('events.arrow')).read_all()
+    or loaded with pd.read_feather.
+    """
+    import pyarrow as pa
+    tables = []
+    for wid in wids:
+        file = f'data/raw/{version}/columns/{wid}.arrow'
+        src = f'data/raw/{version}/events/{wid}.json'
+        # missing or out of date if the events were written by a run without --columnar
+        if not os.path.isfile(file) or os.path.getmtime(file) < os.path.getmtime(src):
+            with open(src) as f:
+                write_event_columns(file, wid, json.load(f))
+        with pa.OSFile(file, 'rb') as source:
+            tables.append(pa.ipc.open_file(source).read_all())
+
+    if not tables:
+        return
+    # the IPC file format requires a single dictionary per column
+    table = pa.concat_tables(tables).unify_dictionaries().combine_chunks()
+    tmp = f'data/raw/{version}/events.arrow.tmp'
+    with pa.OSFile(tmp, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table, max_chunksize=100_000)
+    os.replace(tmp, f'data/raw/{version}/events.arrow')
+    print(f'data/raw/{version}/events.arrow')
+
+def process_participant(version, meta, datastring, columnar=False):
+    """Parses one participant's datastring and writes their events file.
+
+    meta should contain workerid, wid, and start_time. Returns the completed
+    meta dict or None if the participant never initialized the experiment.
+    This runs in a worker process when write_data is called with jobs > 1.
+    """
+    datastring = json.loads(datastring)
+    trialdata = [d['trialdata'] for d in datastring['data']]
+
+    initialized = complete = False
+    for e in trialdata:
+        if e['event'] == 'experiment.initialize':
+            initialized = True
+        elif e['event'] == 'experiment.complete':
+            complete = True
+    if not initialized:
+        return None
+
+    meta = {**pick(datastring, METAKEYS), **meta}
+    meta['active_minutes'] = (datastring['data'][-1]['dateTime'] - datastring['data'][0]['dateTime']) / 60000
+    # meta.update(pick(params, ['pop_name', 'M', 'N', 'K']))
+    meta['complete'] = complete
+
+    with open(f'data/raw/{version}/events/{meta["wid"]}.json', 'w') as f:
+        json.dump(trialdata, f)
+    if columnar:
+        write_event_columns(f'data/raw/{version}/columns/{meta["wid"]}.arrow', meta['wid'], trialdata)
+    return meta
+
+def load_cursor(version):
+    """Maps uniqueid to {'length': len(datastring), 'meta': meta} as of the last fetch.
+
+    The cursor is appended to as each participant is written, so it also lets
+    an interrupted run pick up where it left off. Later lines take precedence.
+    """
+    cursor = {}
+    file = f'data/raw/{version}/cursor.jsonl'
+    if os.path.isfile(file):
+        with open(file) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # partially written line from an interrupted run
+                cursor[entry.pop('uniqueid')] = entry
+    return cursor
+
+def write_cursor(version, cursor):
+    tmp = f'data/raw/{version}/cursor.jsonl.tmp'
+    with open(tmp, 'w') as f:
+        for uid, entry in cursor.items():
+            f.write(json.dumps({'uniqueid': uid, **entry}) + '\n')
+    os.replace(tmp, f'data/raw/{version}/cursor.jsonl')
+
+def write_data(version, mode, full=False, jobs=1, columnar=False):
+    if columnar:
+        try:
+            import pyarrow
+        except ImportError:
+            print('pip install pyarrow to write the columnar event store')
+            exit(1)
+
     anonymize = Anonymizer(enabled = mode == 'live')
 
     if mode != 'local':
@@ -57,7 +176,16 @@ def write_data(version, mode):
         # what should go here??
 
     from psiturk.models import Participant  # must be imported after setting env params
-    ps = Participant.query.filter(Participant.codeversion == version).all()
+    from sqlalchemy import func
+    from sqlalchemy.orm import undefer
+    query = Participant.query.filter(Participant.codeversion == version)
+
+    # Only the datastring lengths are fetched up front. psiTurk only appends to
+    # the datastring, so we skip anyone whose length matches the stored cursor.
+    ps = query.with_entities(
+        Participant.uniqueid, Participant.workerid, Participant.mode,
+        func.length(Participant.datastring)
+    ).all()
 
     if mode == 'live':
         ps = [p for p in ps
@@ -66,44 +194,63 @@ def write_data(version, mode):
             and p.mode == 'live'
         ]
     # Note: we don't filter by completion status.
-
-    metakeys = ['condition', 'useragent']
-    participants = []
+    lengths = {p.uniqueid: p[-1] for p in ps if p[-1] is not None}
 
     os.makedirs(f'data/raw/{version}/events/', exist_ok=True)
-    for p in ps:
-        if p.datastring is None:
-            continue
-        datastring = json.loads(p.datastring)
-
-        trialdata = [d['trialdata'] for d in datastring['data']]
-        try:
-            params = next(e for e in trialdata if e['event'] == 'experiment.initialize')["PARAMS"]
-        except StopIteration:
-            continue
+    if columnar:
+        os.makedirs(f'data/raw/{version}/columns/', exist_ok=True)
+    cursor = {} if full else load_cursor(version)
+    cursor = {uid: c for uid, c in cursor.items() if uid in lengths}
+    write_cursor(version, cursor)  # drops any partially written line before we append
+    changed = [uid for uid, n in lengths.items() if uid not in cursor or cursor[uid]['length'] != n]
 
-        meta = pick(datastring, metakeys)
-        meta['workerid'] = p.workerid
-        meta['wid'] = wid = anonymize(p.workerid)
-        meta['start_time'] = p.beginhit
+    if not full and os.path.isfile(f'data/raw/{version}/identifiers.json'):
+        with open(f'data/raw/{version}/identifiers.json') as f:
+            anonymize.mapping.update(json.load(f))
 
-        meta['active_minutes'] = (datastring['data'][-1]['dateTime'] - datastring['data'][0]['dateTime']) / 60000
+    pool = None
+    if jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        pool = ProcessPoolExecutor(jobs)
 
-        
+    with open(f'data/raw/{version}/cursor.jsonl', 'a') as manifest:
+        for i in range(0, len(changed), 500):
+            page = query.filter(Participant.uniqueid.in_(changed[i:i+500])).options(undefer('datastring')).all()
+            uids = [p.uniqueid for p in page]
+            metas = [{
+                'workerid': p.workerid,
+                'wid': anonymize(p.workerid),
+                'start_time': str(p.beginhit),
+            } for p in page]
+            datastrings = [p.datastring for p in page]
+            del page
 
-        # meta.update(pick(params, ['pop_name', 'M', 'N', 'K']))
+            process = partial(process_participant, version, columnar=columnar)
+            if pool:
+                results = pool.map(process, metas, datastrings, chunksize=max(1, len(uids) // (4 * jobs)))
+            else:
+                results = map(process, metas, datastrings)
 
-        participants.append(meta)
-        meta['complete'] = any(e['event'] == "experiment.complete" for e in trialdata)
+            for uid, meta in zip(uids, results):
+                cursor[uid] = {'length': lengths[uid], 'meta': meta}
+                manifest.write(json.dumps({'uniqueid': uid, **cursor[uid]}) + '\n')
+                manifest.flush()
 
-        with open(f'data/raw/{version}/events/{wid}.json', 'w') as f:
-            json.dump(trialdata, f)
+    if pool:
+        pool.shutdown()
 
+    participants = [c['meta'] for c in cursor.values() if c['meta'] is not None]
     write_csv(f'data/raw/{version}/participants.csv', participants)
 
     with open(f'data/raw/{version}/identifiers.json', 'w') as f:
         json.dump(anonymize.mapping, f)
 
+    write_cursor(version, cursor)  # compact
+
+    if columnar:
+        write_event_store(version, [p['wid'] for p in participants])
+
+    print(len(changed), 'new or updated participants')
     print(len(participants), 'participants', sum(p['complete'] for p in participants), 'complete')
     print(f'data/raw/{version}/participants.csv')
 
@@ -118,6 +265,9 @@ if __name__ == "__main__":
               "data was collected."))
     parser.add_argument("--debug", help="Keep debug participants", action="store_true")
     parser.add_argument("--local", help="Use local database (implies --debug)", action="store_true")
+    parser.add_argument("--full", help="Ignore the saved cursor and rewrite every participant", action="store_true")
+    parser.add_argument("--jobs", help="Number of processes used to parse and write participants", type=int, default=1)
+    parser.add_argument("--columnar", help="Also write all events to a single Arrow file (requires pyarrow)", action="store_true")
 
     args = parser.parse_args()
     mode = 'local' if args.local else 'debug' if args.debug else 'live'
@@ -130,4 +280,4 @@ if __name__ == "__main__":
         version = c["Task Parameters"]["experiment_code_version"]
         print("Fetching data for current version: ", version)
 
-    write_data(version, mode)
+    write_data(version, mode, full=args.full, jobs=args.jobs, columnar=args.columnar)
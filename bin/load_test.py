@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+"""Simulates participants against a running experiment server.
+
+Each simulated participant goes through consent and exp (which assigns a
+condition and creates their row), loads their config, then saves data
+repeatedly with a growing datastring, as setup.js saveData does after every
+trial, and finally marks themself complete. Latency percentiles and error
+rates are reported by route, along with the size of the rows written.
+
+Start the server first (e.g. python bin/herokuapp.py, or psiturk server on),
+then e.g.
+
+    bin/load_test.py -n 50 --concurrency 20 --url http://localhost:22363
+
+Participants get worker ids starting with loadtest; use --cleanup to
+delete their rows afterwards.
+"""
+
+import os
+import json
+import time
+import random
+import threading
+import configparser
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+
+import numpy as np
+import requests
+
+SAVE_TIMEOUT = 10  # seconds, as in setup.js saveData
+
+class Recorder(object):
+    """Collects (route, latency, ok) for every request, from any thread."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = defaultdict(list)
+        self.errors = defaultdict(lambda: defaultdict(int))
+
+    def __call__(self, route, session, method, url, expected=(), **kws):
+        """Sends a request, returning the response unless it failed (statuses in expected don't count)."""
+        start = time.perf_counter()
+        try:
+            r = session.request(method, url, **kws)
+            error = None if r.ok or r.status_code in expected else f'HTTP {r.status_code}'
+        except requests.Timeout:
+            r, error = None, 'timeout'
+        except requests.RequestException as e:
+            r, error = None, type(e).__name__
+        with self.lock:
+            self.latency[route].append(time.perf_counter() - start)
+            if error:
+                self.errors[route][error] += 1
+        return r if error is None else None
+
+    def report(self):
+        print(f'{"route":16} {"n":>6} {"errors":>7} {"p50":>8} {"p90":>8} {"p99":>8} {"max":>8}  (ms)')
+        summary = {}
+        for route, latency in self.latency.items():
+            ms = 1000 * np.array(latency)
+            n_error = sum(self.errors[route].values())
+            p50, p90, p99 = np.percentile(ms, [50, 90, 99])
+            print(f'{route:16} {len(ms):6d} {n_error:7d} {p50:8.1f} {p90:8.1f} {p99:8.1f} {ms.max():8.1f}')
+            summary[route] = {
+                'n': len(ms), 'errors': dict(self.errors[route]), 'error_rate': n_error / len(ms),
+                'p50': p50, 'p90': p90, 'p99': p99, 'max': ms.max(),
+            }
+        return summary
+
+
+def trial_events(t, trial, n_events):
+    """Roughly what one puzzle logs: an initialize with the manual, then enters, selects, and a done."""
+    trial_id = f'loadtest-{trial}'
+    events = [{
+        'event': 'machine.initialize', 'trialID': trial_id, 'task': '12', 'initialCode': '1111',
+        'solutions': {'1234': 'compositional', '5678': 'bespoke'},
+        'blockString': '__________\n111_______\n1112222___\n111_2_____\n____22____',
+        'manual': [{'task': '12', 'kind': 'compositional', 'compositional': True, 'code': '1234',
+                    'blockString': '__________\n111_______\n1112222___\n111_2_____\n____22____'}] * 8,
+    }]
+    for i in range(n_events - 2):
+        if random.random() < .5:
+            events.append({'event': 'machine.enter', 'trialID': trial_id, 'code': '%04d' % random.randrange(10000), 'action': 'nextCode.left'})
+        else:
+            events.append({'event': f'machine.select.{random.randrange(4)}', 'trialID': trial_id})
+    events.append({'event': 'machine.done', 'trialID': trial_id, 'code': '1234', 'solutionType': 'compositional'})
+    records = []
+    for e in events:
+        t += random.randint(100, 2000)
+        e['time'] = t
+        records.append({'current_trial': 0, 'dateTime': t, 'trialdata': e})
+    return t, records
+
+
+def participant(i, args, record):
+    """One simulated participant, start to finish. Returns the number of failed steps."""
+    session = requests.Session()
+    worker_id = f'loadtest{args.run}x{i}'
+    assignment_id = f'{worker_id}a'
+    uid = f'{worker_id}:{assignment_id}'
+    ids = {'hitId': 'loadtest', 'assignmentId': assignment_id, 'workerId': worker_id, 'mode': args.mode}
+    url = args.url.rstrip('/')
+    failures = 0
+
+    if not record('consent', session, 'GET', f'{url}/consent', params=ids, timeout=args.timeout):
+        return 1
+    if not record('exp', session, 'GET', f'{url}/exp', params=ids, timeout=args.timeout):
+        return 1
+    r = record('sync GET', session, 'GET', f'{url}/sync/{uid}', timeout=args.timeout)
+    if r is None:
+        return 1
+    condition = r.json().get('condition', 0)
+    if args.config_dir:
+        # as experiment.js loadConfig: packed configs have an index.json, old-style ones don't
+        config_url = f'{url}/static/json/{args.config_dir}'
+        r = record('config', session, 'GET', f'{config_url}/index.json', expected=(404,), timeout=args.timeout)
+        if r is not None and r.status_code == 404:
+            record('config', session, 'GET', f'{config_url}/{condition}.json', timeout=args.timeout)
+        elif r is not None:
+            index = r.json()
+            for file in [index['configs'][str(condition)], index['shared']]:
+                record('config', session, 'GET', f'{config_url}/{file}', timeout=args.timeout)
+
+    data = []
+    t = int(time.time() * 1000)
+    for trial in range(args.saves):
+        time.sleep(random.expovariate(1 / args.think) if args.think else 0)
+        t, records = trial_events(t, trial, args.events_per_save)
+        data.extend(records)
+        body = {
+            'condition': condition, 'counterbalance': 0, 'assignmentId': assignment_id,
+            'workerId': worker_id, 'hitId': 'loadtest', 'currenttrial': len(data), 'bonus': 0,
+            'data': data, 'questiondata': {}, 'eventdata': [], 'useragent': 'load_test.py', 'mode': args.mode,
+        }
+        if not record('sync PUT', session, 'PUT', f'{url}/sync/{uid}', json=body, timeout=SAVE_TIMEOUT):
+            failures += 1
+
+    if args.complete:
+        if not record('worker_complete', session, 'GET', f'{url}/worker_complete',
+                      params={'uniqueId': uid}, timeout=args.timeout):
+            failures += 1
+    return failures
+
+
+def database(args):
+    """An engine for the server's database (from config.txt unless given) and the participants table name."""
+    from sqlalchemy import create_engine
+    c = configparser.ConfigParser()
+    c.read('config.txt')
+    url = args.database_url or c['Database Parameters']['database_url']
+    return create_engine(url), c['Database Parameters']['table_name']
+
+def row_sizes(args):
+    """Datastring sizes of this run's rows, and the size of the table as a whole."""
+    from sqlalchemy import text
+    engine, table = database(args)
+    with engine.connect() as conn:
+        lengths = [n for n, in conn.execute(
+            text(f'SELECT length(datastring) FROM {table} WHERE workerid LIKE :prefix'),
+            {'prefix': f'loadtest{args.run}x%'}
+        ) if n is not None]
+        if engine.dialect.name == 'postgresql':
+            total = conn.execute(text('SELECT pg_total_relation_size(:t)'), {'t': table}).scalar()
+        elif engine.dialect.name == 'sqlite':
+            total = os.path.getsize(engine.url.database)
+        else:
+            total = None
+    return np.array(lengths), total
+
+def cleanup(args):
+    from sqlalchemy import text
+    engine, table = database(args)
+    with engine.begin() as conn:
+        n = conn.execute(text(f'DELETE FROM {table} WHERE workerid LIKE :prefix'), {'prefix': 'loadtest%'}).rowcount
+        if engine.has_table('participant_index'):
+            conn.execute(text('DELETE FROM participant_index WHERE workerid LIKE :prefix'), {'prefix': 'loadtest%'})
+    print(f'deleted {n} load test participants')
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--url", help="Experiment server", default="http://localhost:22363")
+    parser.add_argument("-n", "--participants", help="Number of participants to simulate", type=int, default=20)
+    parser.add_argument("--concurrency", help="Number of participants active at once", type=int, default=10)
+    parser.add_argument("--arrival-rate", help="New participants per second (0 for all at once)", type=float, default=2)
+    parser.add_argument("--saves", help="Number of saveData calls per participant (one per trial)", type=int, default=12)
+    parser.add_argument("--events-per-save", help="Events logged between saves", type=int, default=150)
+    parser.add_argument("--think", help="Mean seconds between saves", type=float, default=1)
+    parser.add_argument("--mode", help="psiTurk mode for the participants", default="debug")
+    parser.add_argument("--config-dir", help="Also load the packed config from static/json/CONFIG_DIR")
+    parser.add_argument("--complete", help="Call /worker_complete at the end", action="store_true")
+    parser.add_argument("--timeout", help="Timeout for requests other than saves", type=float, default=30)
+    parser.add_argument("--database-url", help="Database to measure row sizes in (default: from config.txt)")
+    parser.add_argument("--no-db", help="Don't measure row sizes", action="store_true")
+    parser.add_argument("--cleanup", help="Delete all load test participants and exit", action="store_true")
+    parser.add_argument("--out", help="Save the results as json")
+    args = parser.parse_args()
+
+    if args.cleanup:
+        cleanup(args)
+        exit()
+
+    args.run = '%x' % int(time.time())
+    record = Recorder()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        futures = []
+        for i in range(args.participants):
+            futures.append(pool.submit(participant, i, args, record))
+            if args.arrival_rate:
+                time.sleep(random.expovariate(args.arrival_rate))
+        failures = [f.result() for f in futures]
+    elapsed = time.perf_counter() - start
+
+    n_request = sum(len(x) for x in record.latency.values())
+    print(f'{args.participants} participants, {n_request} requests in {elapsed:.1f}s '
+          f'({n_request / elapsed:.1f} requests/s), {sum(f > 0 for f in failures)} participants with errors\n')
+    results = {'args': {k: v for k, v in vars(args).items()}, 'elapsed': elapsed, 'routes': record.report()}
+
+    if not args.no_db:
+        lengths, total = row_sizes(args)
+        if len(lengths):
+            print(f'\ndatastring: mean {lengths.mean() / 1024:.0f} kB, max {lengths.max() / 1024:.0f} kB over {len(lengths)} rows')
+            results['datastring_kb'] = {'mean': lengths.mean() / 1024, 'max': lengths.max() / 1024}
+        if total:
+            print(f'table size: {total / 2**20:.1f} MB')
+            results['table_mb'] = total / 2**20
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2, default=float)
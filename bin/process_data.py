@@ -1,9 +1,12 @@
 #!/usr/bin/env python3
 import pandas as pd
+import numpy as np
 import os
 from ast import literal_eval
 import json
 import sys
+import csv
+from functools import partial
 import bonus
 
 def all_nan(col):
@@ -16,10 +19,182 @@ def drop_nan_cols(df):
     return df[[name for name, col in df.iteritems()
                if not all_nan(col)]]
 
-def main(codeversion):
+TRIAL_COLUMNS = [
+    'wid', 'config_dir', 'condition', 'phase', 'trial_index', 'trialID', 'task', 'n_manual', 'done', 'solution_type',
+    'code', 'rt', 'n_enter', 'n_select', 'n_button_left', 'n_button_right', 'n_button_bespoke',
+    'n_partial', 'n_undo', 'n_manual_update',
+]
+# digit strings, which read_csv would otherwise parse as numbers (floats if any are missing)
+TRIAL_DTYPES = {'task': str, 'code': str,
+                'target': str, 'code_compositional': str, 'code_bespoke': str}  # from join_catalog
+
+def trial_metrics(wid, events):
+    """One record per puzzle, from machine.initialize to machine.done.
+
+    Puzzles before experiment.main are from the instructions. A puzzle that
+    was never finished (e.g. the participant quit) has done=False.
+    """
+    trials = []
+    phase = 'instructions'
+    count = {'instructions': 0, 'main': 0}
+    trial = None
+    config_dir = condition = None
+    for e in events:
+        event = e['event']
+        if event == 'experiment.initialize':
+            config_dir = e.get('PARAMS', {}).get('config_dir')
+            condition = e.get('CONDITION')
+        elif event == 'experiment.main':
+            phase = 'main'
+        elif event == 'machine.initialize':
+            trial = dict.fromkeys(TRIAL_COLUMNS, 0)
+            trial.update({
+                'wid': wid,
+                'config_dir': config_dir,
+                'condition': condition,
+                'phase': phase,
+                'trial_index': count[phase],
+                'trialID': e.get('trialID'),
+                'task': e.get('task'),
+                'n_manual': len(e.get('manual') or []),
+                'done': False,
+                'solution_type': None,
+                'code': None,
+                'rt': None,
+                'start': e['time'],
+            })
+            trials.append(trial)
+            count[phase] += 1
+        elif trial is None or not event.startswith('machine.'):
+            continue
+        elif event == 'machine.done':
+            trial['done'] = True
+            trial['solution_type'] = e.get('solutionType')
+            trial['code'] = e.get('code')
+            trial['rt'] = (e['time'] - trial['start']) / 1000
+            trial = None
+        elif event == 'machine.enter':
+            trial['n_enter'] += 1
+        elif event.startswith('machine.select.'):
+            trial['n_select'] += 1
+        elif event.startswith('machine.button.'):
+            key = 'n_button_' + event.rsplit('.', 1)[1]
+            if key in trial:
+                trial[key] += 1
+        elif event in ('machine.solution.left', 'machine.solution.right'):
+            trial['n_partial'] += 1
+        elif event == 'machine.undo-partial':
+            trial['n_undo'] += 1
+        elif event == 'machine.manual.update':
+            trial['n_manual_update'] += 1
+    for t in trials:
+        del t['start']
+    return trials
+
+def process_events(version, wid):
+    """Writes the trial records for one participant, unless their events haven't changed since."""
+    src = f'data/raw/{version}/events/{wid}.json'
+    dest = f'data/processed/{version}/trials/{wid}.json'
+    if os.path.isfile(dest) and os.path.getmtime(dest) >= os.path.getmtime(src):
+        with open(dest) as f:
+            if json.load(f)['columns'] == TRIAL_COLUMNS:
+                return False
+    with open(src) as f:
+        trials = trial_metrics(wid, json.load(f))
+    tmp = dest + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'columns': TRIAL_COLUMNS, 'trials': trials}, f)
+    os.replace(tmp, dest)
+    return True
+
+def load_catalog(config_dir):
+    """The trial designs written by generate_configs.py, memory-mapped from static/json/<config_dir>/catalog.arrow."""
+    import pyarrow as pa
+    return pa.ipc.open_file(pa.memory_map(f'static/json/{config_dir}/catalog.arrow')).read_all().to_pandas()
+
+def join_catalog(trials):
+    """Adds the design of each main trial (from the stimulus catalog) to the trials table.
+
+    Trials are matched on config_dir, condition, and trial index in a single
+    merge; the catalog's trialID is only used as a check.
+    """
+    try:
+        import pyarrow
+    except ImportError:
+        print('pip install pyarrow to add the trial designs')
+        return trials
+    catalogs = []
+    for config_dir in trials.config_dir.dropna().unique():
+        if not os.path.isfile(f'static/json/{config_dir}/catalog.arrow'):
+            print(f'no stimulus catalog for {config_dir}; run python generate_configs.py --catalog -o static/json/{config_dir}')
+            continue
+        catalog = load_catalog(config_dir).drop(columns='n_manual')  # already in trials
+        catalogs.append(catalog.assign(config_dir=config_dir, phase='main'))
+    if not catalogs:
+        return trials
+
+    catalog = pd.concat(catalogs, ignore_index=True)
+    for col in ['config_dir', 'phase']:
+        catalog[col] = catalog[col].astype(object)
+    trials = trials.merge(catalog, how='left', on=['config_dir', 'condition', 'phase', 'trial_index'],
+                          suffixes=('', '_catalog'))
+    mismatch = trials.trialID_catalog.notna() & (trials.trialID_catalog.astype(object) != trials.trialID)
+    if mismatch.any():
+        print(f'WARNING: {mismatch.sum()} trials have a different trialID than the catalog')
+    return trials.drop(columns='trialID_catalog')
+
+def write_trials(version, jobs=1, full=False):
+    """Writes data/processed/<version>/trials.csv with one row per puzzle.
+
+    Each participant's events are parsed once, in parallel if jobs > 1, and
+    the result is kept in data/processed/<version>/trials/ so that later runs
+    only reparse participants whose events file has been rewritten by
+    fetch_data.py. Use full=True to reparse everyone. Main trials are then
+    joined to their design from the stimulus catalog (see join_catalog).
+    Read the result with load_trials, since plain read_csv parses the codes
+    as numbers.
+    """
+    out = f'data/processed/{version}'
+    os.makedirs(f'{out}/trials', exist_ok=True)
+    wids = pd.read_csv(f'data/raw/{version}/participants.csv').wid
+    if full:
+        for wid in wids:
+            if os.path.isfile(f'{out}/trials/{wid}.json'):
+                os.remove(f'{out}/trials/{wid}.json')
+
+    process = partial(process_events, version)
+    if jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(jobs) as pool:
+            changed = list(pool.map(process, wids, chunksize=max(1, len(wids) // (4 * jobs))))
+    else:
+        changed = list(map(process, wids))
+
+    tmp = f'{out}/trials.csv.tmp'
+    with open(tmp, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=TRIAL_COLUMNS)
+        writer.writeheader()
+        for wid in wids:
+            with open(f'{out}/trials/{wid}.json') as g:
+                writer.writerows(json.load(g)['trials'])
+    os.replace(tmp, f'{out}/trials.csv')
+
+    trials = load_trials(version)
+    if trials.config_dir.notna().any():
+        join_catalog(trials).to_csv(f'{out}/trials.csv', index=False)
+    print(sum(changed), 'of', len(changed), 'participants reprocessed')
+    print(f'{out}/trials.csv')
+
+def load_trials(version):
+    """Reads data/processed/<version>/trials.csv, keeping codes and tasks as strings (see TRIAL_DTYPES)."""
+    return pd.read_csv(f'data/processed/{version}/trials.csv', dtype=TRIAL_DTYPES)
+
+def main(codeversion, jobs=1, full=False):
     out = f'data/processed/{codeversion}'
     os.makedirs(out, exist_ok=True)
 
+    write_trials(codeversion, jobs=jobs, full=full)
+
     def load_raw(kind):
         return drop_nan_cols(pd.read_csv(f'data/human/{codeversion}/{kind}.csv'))
 
@@ -32,4 +207,14 @@ def main(codeversion):
     bonus.main(codeversion)
 
 if __name__ == '__main__':
-    main(sys.argv[1])
+    from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument("version", help="Experiment version, as passed to fetch_data.py")
+    parser.add_argument("--jobs", help="Number of processes used to parse participants", type=int, default=1)
+    parser.add_argument("--full", help="Reparse every participant, even if their events haven't changed", action="store_true")
+    parser.add_argument("--trials-only", help="Only write trials.csv", action="store_true")
+    args = parser.parse_args()
+    if args.trials_only:
+        write_trials(args.version, jobs=args.jobs, full=args.full)
+    else:
+        main(args.version, jobs=args.jobs, full=args.full)
@@ -3,12 +3,74 @@ import sys
 import subprocess
 import os
 import re
+import json
+import time
+import threading
+from glob import glob
 import requests
+from urllib3.exceptions import NewConnectionError
 from configparser import ConfigParser
 from markdown import markdown
 import random
 from fire import Fire
-from functools import cache, cached_property
+from functools import cached_property
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import atexit
+
+
+class ProlificError(Exception):
+    """A request to the Prolific API failed (after any retries)."""
+
+
+class ResponseCache(object):
+    """Persistent cache of Prolific API listings, stored as json files in `directory`.
+
+    Entries are keyed by the request url (made filename safe), so all entries
+    under a url prefix can be invalidated together. Loaded entries are also
+    kept in memory.
+    """
+    def __init__(self, directory='.prolific_cache'):
+        self.directory = directory
+        self.memory = {}
+
+    @staticmethod
+    def _key(url):
+        return re.sub(r'\W+', '_', url).strip('_')
+
+    def _file(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, url):
+        key = self._key(url)
+        if key not in self.memory:
+            try:
+                with open(self._file(key)) as f:
+                    self.memory[key] = json.load(f)
+            except (FileNotFoundError, ValueError):
+                return None
+        return self.memory[key]
+
+    def set(self, url, entry):
+        key = self._key(url)
+        self.memory[key] = entry
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = f'{self._file(key)}.{threading.get_ident()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp, self._file(key))
+
+    def invalidate(self, url_prefix=''):
+        prefix = self._key(url_prefix)
+        for key in list(self.memory):
+            if key.startswith(prefix):
+                del self.memory[key]
+        for file in glob(os.path.join(self.directory, prefix + '*.json')):
+            try:
+                os.remove(file)
+            except FileNotFoundError:
+                pass
 
 
 class Prolific(object):
@@ -18,7 +80,9 @@ class Prolific(object):
     actual study id or an index such that 0 (the default value) is the most
     recently posted study, 1 is the one before that, etc...
     """
-    def __init__(self, token=None):
+    def __init__(self, token=None, max_workers=8, cache_ttl=60, max_retries=4,
+                 timeout=(5, 60), backoff=1, max_backoff=60, verbose=False, stats=False,
+                 base_url=None):
         super(Prolific, self).__init__()
         if token is None:
             token = find_token()
@@ -26,12 +90,35 @@ class Prolific(object):
             raise ValueError('You must provide a token, create a .prolific_token file, or set a PROLIFIC_TOKEN environment variable.')
 
         self.token = token
+        # e.g. PROLIFIC_API_URL=http://localhost:5001/api/v1 to use bin/fake_prolific.py
+        self.base_url = (base_url or os.getenv('PROLIFIC_API_URL') or 'https://api.prolific.co/api/v1').rstrip('/')
+        self.max_workers = max_workers
+        # requests are retried up to max_retries times, waiting backoff * 2^attempt
+        # seconds (capped at max_backoff) or whatever Retry-After asks for
+        self.max_retries = max_retries
+        self.timeout = timeout  # (connect, read) in seconds
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.verbose = verbose
+        self.metrics = []  # one record per request; see print_stats
+        if stats:
+            atexit.register(self.print_stats)
+        # one keep-alive connection pool shared by all requests (and threads)
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = f'Token {token}'
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        # listings are cached on disk for cache_ttl seconds (forever for submissions
+        # fetched after their study completed, except when approving or paying)
+        self.cache = ResponseCache(os.path.join('.prolific_cache', ResponseCache._key(self.base_url)))
+        self.cache_ttl = cache_ttl
 
     @cached_property
     def project_id(self):
         if os.path.isfile('.project_id'):
             with open('.project_id') as f:
-                return f.read()
+                return f.read().strip()
         else:
             print(
                 "Please enter your prolific project id.\n"
@@ -48,54 +135,188 @@ class Prolific(object):
                 print("Saved to .project_id - we won't ask again.")
             return project_id
 
-    def _request(self, method, url, json=None, **kws):
+    def _send(self, method, url, json=None, idempotent=None, **kws):
+        """Sends a request, retrying when that is safe.
+
+        429 and 503 responses are always retried, since the server did not
+        process the request. Other 5xx responses, timeouts, and dropped
+        connections are only retried for idempotent requests (all but POST,
+        unless idempotent=True is passed), since the request may have taken
+        effect. Failing to connect at all (a connect timeout or a refused
+        connection) is always retried, since the request was never sent.
+        """
         if url.startswith('/'):
-            url = 'https://api.prolific.co/api/v1' + url
+            url = self.base_url + url
         if not url.endswith('/') and '?' not in url:  # adding / prevents redirecting POST requests
             url += '/'
-        print(method, url)
-        r = requests.request(method, url, **kws, json=json, headers={
-            'Authorization': f'Token {self.token}',
+        if idempotent is None:
+            idempotent = method != 'POST'
+        kws.setdefault('timeout', self.timeout)
+        if self.verbose:
+            print(method, url)
+
+        start = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            last = attempt == self.max_retries
+            try:
+                r = self.session.request(method, url, **kws, json=json)
+            except requests.RequestException as e:
+                if last or not (idempotent or never_sent(e)):
+                    self._record(method, url, 'error', start, attempt)
+                    raise ProlificError(f'{method} {url} failed: {e}') from e
+                delay = self._backoff_delay(attempt)
+                reason = type(e).__name__
+            else:
+                retry = r.status_code in (429, 503) or (idempotent and r.status_code >= 500)
+                if last or not retry:
+                    self._record(method, url, r.status_code, start, attempt)
+                    return r
+                delay = retry_after(r)
+                if delay is None:
+                    delay = self._backoff_delay(attempt)
+                reason = r.status_code
+            print(f'{method} {url} failed ({reason}); retrying in {delay:.1f}s')
+            time.sleep(delay)
+
+    def _backoff_delay(self, attempt):
+        # full jitter, so concurrent requests don't retry in lockstep
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def _record(self, method, url, status, start, attempt):
+        self.metrics.append({
+            'method': method,
+            # replace ids so requests to the same endpoint are grouped together
+            'endpoint': re.sub(r'/[0-9a-f]{24}(?=/|$)', '/{id}', url.split('?')[0].replace(self.base_url, '')),
+            'status': status,
+            'seconds': time.perf_counter() - start,
+            'attempts': attempt + 1,
         })
+
+    def print_stats(self):
+        """Prints request counts and latencies by endpoint"""
+        if not self.metrics:
+            return
+        import pandas as pd
+        df = pd.DataFrame(self.metrics)
+        stats = df.groupby(['method', 'endpoint']).agg(
+            n=('seconds', 'size'),
+            retries=('attempts', lambda x: (x - 1).sum()),
+            errors=('status', lambda x: sum(s == 'error' or s >= 400 for s in x)),
+            median=('seconds', 'median'),
+            p95=('seconds', lambda x: x.quantile(.95)),
+            total=('seconds', 'sum'),
+        )
+        print(stats.round(3).to_string())
+
+    def _request(self, method, url, json=None, idempotent=None, **kws):
+        response = self._parse(self._send(method, url, json, idempotent, **kws))
+        if method != 'GET':
+            self._invalidate(url, json)
+        return response
+
+    def _parse(self, r):
         try:
             response = r.json()
-        except:
-            print(r.text)
-            return
+        except ValueError:
+            response = r.text
         if r.ok:
-            return response
+            return response if response != '' else None
         else:
-            print(f'Problem with API request: {url}')
-            print(response)
-            exit(1)
+            raise ProlificError(f'Problem with API request: {r.request.method} {r.url} ({r.status_code})\n{response}')
+
+    def _invalidate(self, url, payload):
+        # drop cached listings that a successful change could affect
+        self.cache.invalidate('/projects/')
+        m = re.search(r'/studies/(\w+)', url)
+        study_id = m.group(1) if m else (payload or {}).get('study_id')
+        if study_id:
+            self.cache.invalidate(f'/studies/{study_id}/submissions')
+
+    def _get_all(self, url, terminal=False, fresh=False):
+        """GET every page of a list endpoint, following the next links.
+
+        Results are cached. Entries younger than cache_ttl seconds are used as
+        is, as are entries fetched with terminal=True, which never expire.
+        Older single-page listings (or any, with fresh=True) are revalidated
+        with If-None-Match / If-Modified-Since; multi-page listings are
+        refetched, since the first page's validators don't cover the rest.
+        """
+        entry = self.cache.get(url)
+        if entry and not fresh and (entry.get('terminal') or time.time() - entry['time'] < self.cache_ttl):
+            return entry['results']
+
+        headers = {}
+        if entry and entry['revalidate']:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+        r = self._send('GET', url, headers=headers)
+        if headers and r.status_code == 304:
+            self.cache.set(url, {**entry, 'time': time.time(), 'terminal': terminal})
+            return entry['results']
+        res = self._parse(r)
+
+        results = list(res['results'])
+        next_url = (res.get('_links', {}).get('next') or {}).get('href')
+        single_page = next_url is None
+        while next_url:
+            res = self._request('GET', next_url)
+            results.extend(res['results'])
+            next_url = (res.get('_links', {}).get('next') or {}).get('href')
+        if len(results) != res.get('meta', {}).get('count', len(results)):
+            print(f"WARNING: expected {res['meta']['count']} results but got {len(results)}")
+
+        self.cache.set(url, {
+            'time': time.time(),
+            'revalidate': single_page,
+            'etag': r.headers.get('ETag'),
+            'last_modified': r.headers.get('Last-Modified'),
+            'results': results,
+            'terminal': terminal,
+        })
+        return results
 
-    @cache
     def _studies(self, state="active|paused|completed|awaiting review|unknown", limit=1000):
         "ACTIVE" "PAUSED" "UNPUBLISHED" "PUBLISHING" "COMPLETED" "AWAITING REVIEW" "UNKNOWN" "SCHEDULED"
         #  Accepts a string in the format "(active|published|...)"
+        # limit is the page size; all pages are retrieved
+
+        # return [s for s in res['results'] if s['status'] != 'UNPUBLISHED' ]
+        return self._get_all(self._studies_url(state, limit))
 
+    def _studies_url(self, state="active|paused|completed|awaiting review|unknown", limit=1000):
         url = f'/projects/{self.project_id}/studies?limit={limit}'
         if state:
             url += f'&state=({state})'
-        res = self._request('GET', url)
-        if len(res['results']) != res['meta']['count']:
-            print("Some studies were not retrieved. You might have to implemnent paging.")
-        # return [s for s in res['results'] if s['status'] != 'UNPUBLISHED' ]
-        return res['results']
-
-    @cache
-    def _submissions(self, study_id):
-        res = self._request('GET', f'/studies/{study_id}/submissions?limit=1000')
-        if len(res['results']) != res['meta']['count']:
-            print("Some submissions were not retrieved. You might have to implemnent paging.")
-            exit(1)
-        return res['results']
+        return url
+
+    def _submissions(self, study_id, fresh=False):
+        # Submissions of completed studies rarely change, so for reports a
+        # listing fetched after the study completed never expires. One fetched
+        # earlier still expires as usual. COMPLETED is terminal, so a stale
+        # studies listing is fine for checking this. Anything that approves or
+        # pays must pass fresh=True, since the submissions can also change
+        # from elsewhere (the web app, or this script on another machine).
+        entry = self.cache.get(self._studies_url())
+        studies = entry['results'] if entry else self._studies()
+        study = next((s for s in studies if s['id'] == study_id), None)
+        completed = study is not None and study['status'] == 'COMPLETED'
+        return self._get_all(f'/studies/{study_id}/submissions?limit=1000', terminal=completed, fresh=fresh)
+
+    def _all_submissions(self, study_ids):
+        """Maps each study id to its submissions, fetching studies concurrently."""
+        study_ids = list(study_ids)
+        with ThreadPoolExecutor(self.max_workers) as pool:
+            return dict(zip(study_ids, pool.map(self._submissions, study_ids)))
 
     def summary_csv(self):
         """Generates a summary of all participants for this project"""
         records = []
-        for study in self._studies():
-            for sub in self._submissions(study['id']):
+        studies = self._studies()
+        submissions = self._all_submissions(s['id'] for s in studies)
+        for study in studies:
+            for sub in submissions[study['id']]:
 
                 records.append({
                     'internal_name': study['internal_name'],
@@ -115,12 +336,8 @@ class Prolific(object):
         pd.DataFrame(records).to_csv('prolific_summary.csv')
 
 
-    def approve(self, study=0, ignore_code=False):
-        """Approve all submissions of the last study.
-
-        The "last" study refers to the most recently posted study within your project
-        """
-        study_id = self.study_id(study)
+    def _approval_plan(self, study_id, ignore_code=False):
+        """Participants awaiting review in the study, split by whether their code is correct."""
         to_approve = []
         bad_code = []
         completion_codes = [x['code']
@@ -128,31 +345,72 @@ class Prolific(object):
             if x['code_type'] == "COMPLETED"
         ]
 
-        for sub in self._submissions(study_id):
+        for sub in self._submissions(study_id, fresh=True):
             if sub['status'] != 'AWAITING REVIEW':
                 continue
             if ignore_code or sub['study_code'] in completion_codes:
                 to_approve.append(sub["participant_id"])
             else:
                 bad_code.append(sub["participant_id"])
+        return to_approve, bad_code
+
+    def _bonus_plan(self, study_id, bonuses):
+        """Bonus still due to each participant in the study (and participants not in the study)."""
+        previous_bonus = {sub['participant_id']: sum(sub['bonus_payments']) / 100
+                          for sub in self._submissions(study_id, fresh=True)}
+
+        # n_bonused = sum(previous_bonus > 0)
+        # if n_bonused:
+        #     print(f'{n_bonused} participants already have bonuses, {len(bonuses) - n_bonused} to be bonused')
+        participants = previous_bonus.keys()
+        missing = set(bonuses.keys()) - set(participants)
 
+        new_bonus = {
+            p: bonuses.get(p, 0) - previous_bonus[p] for p in participants
+        }
+        return {p: bonus for p, bonus in new_bonus.items() if bonus > 0}, missing
+
+    def _approve(self, study_id, to_approve):
+        # approving an already approved submission has no further effect
+        self._request('POST', "/submissions/bulk-approve/", {
+            "study_id": study_id,
+            "participant_ids": to_approve
+        }, idempotent=True)
+
+    def _setup_bonuses(self, study_id, new_bonus):
+        """Creates (but doesn't pay) a bulk bonus payment; returns the response with id and total_amount."""
+        return self._request('POST', '/submissions/bonus-payments/', {
+            'study_id': study_id,
+            'csv_bonuses': '\n'.join(f'{p},{bonus:.2f}' for p, bonus in new_bonus.items())
+        })
+
+    def _pay_bonuses(self, study_id, payment_id):
+        """Pays a bulk bonus payment created by _setup_bonuses."""
+        self._request('POST', f'/bulk-bonus-payments/{payment_id}/pay/')
+        # the url doesn't name the study, so _request can't invalidate its submissions
+        self.cache.invalidate(f'/studies/{study_id}/submissions')
+
+    def approve(self, study=0, ignore_code=False):
+        """Approve all submissions of the last study.
+
+        The "last" study refers to the most recently posted study within your project
+        """
+        study_id = self.study_id(study)
+        to_approve, bad_code = self._approval_plan(study_id, ignore_code)
 
         if bad_code:
             print(f'{len(bad_code)} submissions have an incorrect code. Check',
                 f"https://app.prolific.co/researcher/workspaces/studies/{study_id}/submissions")
 
         if to_approve:
-            self._request('POST', "/submissions/bulk-approve/", {
-                "study_id": study_id,
-                "participant_ids": to_approve
-            })
+            self._approve(study_id, to_approve)
             print(f'Approved {len(to_approve)} submissions')
         else:
             print('No submissions to approve')
 
     def all_study_bonus(self, bonuses='bonus.csv', n=10):
-        for i in range(n):
-            self.assign_bonuses(i, bonuses)
+        """Assign bonuses for the last n studies (see pay_all)"""
+        self.pay_all(n, bonuses, approve=False)
 
 
     def assign_bonuses(self, study=0, bonuses='bonus.csv'):
@@ -161,51 +419,23 @@ class Prolific(object):
         By default will use bonus.csv, which has format workerid,bonus_in_dollars (no header).
         """
         study_id = self.study_id(study)
+        bonuses = load_bonuses(bonuses)
+        new_bonus, missing = self._bonus_plan(study_id, bonuses)
 
-        if isinstance(bonuses, str):
-            file = bonuses
-
-            if file.endswith('.json'):
-                import json
-                with open(file) as f:
-                    bonuses = json.load(f)
-
-            if file.endswith('.csv'):
-                import pandas as pd
-                bonuses = dict(pd.read_csv(file, header=None).set_index(0)[1])
-
-        assert isinstance(bonuses, dict)
-
-        previous_bonus = {sub['participant_id']: sum(sub['bonus_payments']) / 100
-                          for sub in self._submissions(study_id)}
-
-        # n_bonused = sum(previous_bonus > 0)
-        # if n_bonused:
-        #     print(f'{n_bonused} participants already have bonuses, {len(bonuses) - n_bonused} to be bonused')
-        participants = previous_bonus.keys()
-        missing = set(bonuses.keys()) - set(participants)
         if missing:
             print('WARNING: some entries of bonuses.csv do not have submissions. Skipping these.')
             print('\n'.join(f'{p},{bonus:.2f}' for p, bonus in bonuses.items() if p in missing))
             print()
 
-        new_bonus = {
-            p: bonuses.get(p, 0) - previous_bonus[p] for p in participants
-        }
-        bonus_string = '\n'.join(f'{p},{bonus:.2f}' for p, bonus in new_bonus.items() if bonus > 0)
-
-        if not bonus_string:
+        if not new_bonus:
             print('No bonuses due')
         else:
-            resp = self._request('POST', '/submissions/bonus-payments/', {
-                'study_id': study_id,
-                'csv_bonuses': bonus_string
-            })
+            resp = self._setup_bonuses(study_id, new_bonus)
 
             amt = resp['total_amount'] / 100
             yes = input(f'Pay ${amt:.2f} in bonuses? [N/y]: ')
             if yes == 'y':
-                self._request('POST', f'/bulk-bonus-payments/{resp["id"]}/pay/')
+                self._pay_bonuses(study_id, resp['id'])
                 print('Bonuses paid')
             else:
                 print('NOT paying bonuses')
@@ -216,9 +446,92 @@ class Prolific(object):
         self.assign_bonuses(study, bonuses)
 
     def approve_all(self, n=10):
-        for i in range(n):
-            self.approve(i)
+        """Approve submissions for the last n studies (see pay_all)"""
+        self.pay_all(n, bonuses=None, yes=True)
+
+    def pay_all(self, n=10, bonuses='bonus.csv', approve=True, ignore_code=False, yes=False):
+        """Approve submissions and pay bonuses for the last n studies at once.
+
+        Everything that's due is collected for all studies concurrently and
+        shown in one summary; after a single confirmation, all approvals and
+        bonus payments are submitted concurrently. The outcome of each is
+        printed as it finishes, and if any failed, a ProlificError listing
+        them is raised at the end. Pass bonuses=None to only approve or
+        approve=False to only pay bonuses.
+        """
+        studies = {s['id']: s for s in self._studies()}
+        study_ids = [self.study_id(i) for i in range(min(n, len(studies)))]
+        bonuses = {} if bonuses is None else load_bonuses(bonuses)
+
+        def plan(study_id):
+            to_approve, bad_code = self._approval_plan(study_id, ignore_code) if approve else ([], [])
+            new_bonus, missing = self._bonus_plan(study_id, bonuses)
+            resp = self._setup_bonuses(study_id, new_bonus) if new_bonus else None
+            return {
+                'study_id': study_id,
+                'to_approve': to_approve,
+                'bad_code': bad_code,
+                'n_bonus': len(new_bonus),
+                'missing': missing,
+                'bonus_payment': resp,
+            }
+
+        with ThreadPoolExecutor(self.max_workers) as pool:
+            plans = list(pool.map(plan, study_ids))
+
+        print('\n------------------------------ payment summary ------------------------------')
+        for p in plans:
+            amt = p['bonus_payment']['total_amount'] / 100 if p['bonus_payment'] else 0
+            print(f"{studies[p['study_id']]['internal_name']:40} approve {len(p['to_approve']):4}  "
+                  f"bonus {p['n_bonus']:4} (${amt:.2f})"
+                  + (f"  BAD CODE {len(p['bad_code'])}" if p['bad_code'] else ''))
+            if p['bad_code']:
+                print(f"    check https://app.prolific.co/researcher/workspaces/studies/{p['study_id']}/submissions")
+        missing = set.intersection(*(p['missing'] for p in plans)) if plans else set()
+        if bonuses and missing:
+            print(f'WARNING: {len(missing)} entries of the bonus file do not have submissions in any of these studies:')
+            print('\n'.join(f'{p},{bonuses[p]:.2f}' for p in missing))
+        n_approve = sum(len(p['to_approve']) for p in plans)
+        payments = [p['bonus_payment'] for p in plans if p['bonus_payment']]
+        total = sum(resp['total_amount'] for resp in payments) / 100
+        print('-----------------------------------------------------------------------------')
+        print(f'TOTAL: approve {n_approve} submissions, pay ${total:.2f} in bonuses')
+
+        if not (n_approve or payments):
+            print('Nothing to do')
+            return
+        confirm = 'y' if yes else input('Go ahead? [N/y]: ')
+        if confirm.lower() != 'y':
+            print('NOT approving or paying')
+            return
 
+        # (study_id, what, amount, function, *args) for each request
+        jobs = [(p['study_id'], 'approve', len(p['to_approve']), self._approve, p['study_id'], p['to_approve'])
+                for p in plans if p['to_approve']]
+        jobs += [(p['study_id'], 'pay', p['bonus_payment']['total_amount'] / 100,
+                  self._pay_bonuses, p['study_id'], p['bonus_payment']['id'])
+                 for p in plans if p['bonus_payment']]
+        done = {'approve': 0, 'pay': 0}
+        failed = []
+        # report every job, so a failure doesn't hide what already went through
+        with ThreadPoolExecutor(self.max_workers) as pool:
+            futures = {pool.submit(fn, *args): (study_id, what, amount) for study_id, what, amount, fn, *args in jobs}
+            for future in as_completed(futures):
+                study_id, what, amount = futures[future]
+                desc = f'approve {amount} submissions' if what == 'approve' else f'pay ${amount:.2f} in bonuses'
+                name = studies[study_id]['internal_name']
+                try:
+                    future.result()
+                except Exception as e:
+                    failed.append((name, desc))
+                    print(f'{name:40} FAILED to {desc}: {e}')
+                else:
+                    done[what] += amount
+                    print(f'{name:40} {desc}: done')
+        print(f"Approved {done['approve']} submissions and paid ${done['pay']:.2f} in bonuses")
+        if failed:
+            raise ProlificError(f'{len(failed)} of {len(jobs)} requests failed: ' +
+                                ', '.join(f'{name} ({desc})' for name, desc in failed))
 
     def update_places(self, new_total, study=0):
         """Set the total number of participants for the last study to `new_total`
@@ -234,14 +547,14 @@ class Prolific(object):
         study_id = self.study_id(study)
         self._request('POST', f'/studies/{study_id}/transition/', {
             "action": "PAUSE"
-        })
+        }, idempotent=True)
 
     def start(self, study=0):
         """Resume recruiting participants (after pausing)"""
         study_id = self.study_id(study)
         self._request('POST', f'/studies/{study_id}/transition/', {
             "action": "START"
-        })
+        }, idempotent=True)
 
     def link(self, study=0):
         """Print the link to the submissions page for the given study"""
@@ -256,7 +569,7 @@ class Prolific(object):
         """The study id for the study run `n` studies ago (0 is most recent)."""
         if isinstance(n, str): 
             return n
-        return self._studies(limit=n+1)[-(n+1)]['id']
+        return self._studies()[-(n+1)]['id']
 
     def post_duplicate(self, study=0, yes=False, force=False, **kws):
         """Post a duplicate of the given study using current fields in config.txt"""
@@ -329,7 +642,7 @@ class Prolific(object):
         if confirm.lower() == 'y':
             self._request('POST', f'/studies/{new_id}/transition/', {
                 "action": "PUBLISH"
-            })
+            }, idempotent=True)
             print('Posted! See submssisions at:')
             print(f'https://app.prolific.co/researcher/workspaces/studies/{new_id}/submissions')
         else:
@@ -341,50 +654,136 @@ class Prolific(object):
         for study in self._studies(state='unpublished'):
             self._request('DELETE', f'/studies/{study["id"]}')
 
-    def check_wage(self, study=0, target_wage=12):
-        """Summarizes time and total payment for the given study"""
-        study_id = self.study_id(study)
-        from dateutil.parser import parse
+    def _wage_data(self, study_ids):
+        """One row per complete submission with hours taken and total pay (base + bonus) in dollars."""
+        import pandas as pd
+        studies = {s['id']: s for s in self._studies()}
+        submissions = self._all_submissions(study_ids)
+        records = []
+        for study_id, subs in submissions.items():
+            study = studies.get(study_id) or self._request('GET', f'/studies/{study_id}')
+            for sub in subs:
+                if not sub['is_complete']:
+                    continue
+                records.append({
+                    'study_id': study_id,
+                    'internal_name': study['internal_name'],
+                    'basepay': study['reward'] / 100,
+                    'bonus': sum(sub['bonus_payments']) / 100,
+                    'started_at': sub['started_at'],
+                    'completed_at': sub['completed_at'],
+                })
+        df = pd.DataFrame(records, columns=['study_id', 'internal_name', 'basepay', 'bonus', 'started_at', 'completed_at'])
+        started = pd.to_datetime(df.started_at, utc=True, format='ISO8601')
+        completed = pd.to_datetime(df.completed_at, utc=True, format='ISO8601')
+        df['hours'] = (completed - started).dt.total_seconds() / 3600
+        df['pay'] = df.basepay + df.bonus
+        df['wage'] = df.pay / df.hours
+        return df
+
+    def check_wage(self, study=0, target_wage=12, n=None, all_studies=False):
+        """Summarizes time and total payment for the given study
+
+        With --n or --all_studies, summarizes the last n (or all) studies, each and pooled.
+        """
         import numpy as np
+        if all_studies:
+            study_ids = [s['id'] for s in self._studies()]
+        elif n:
+            study_ids = [self.study_id(i) for i in range(min(n, len(self._studies())))]
+        else:
+            study_ids = [self.study_id(study)]
 
-        basepay = self._request('GET', f'/studies/{study_id}')['reward']
-
-        times = []
-        pays = []
-        for sub in self._request('GET', f'/studies/{study_id}/submissions')['results']:
-            if not sub['is_complete']:
-                continue
-            seconds = (parse(sub['completed_at']) - parse(sub['started_at'])).total_seconds()
-            hrs = seconds / 3600
-            times.append(hrs)
-            bonus = sum(sub['bonus_payments'])
-            totalpay = (basepay + bonus) / 100
-            pays.append(totalpay)
+        df = self._wage_data(study_ids)
+        if df.empty:
+            print('no complete submissions')
+            return
 
-        pays = np.array(pays)
-        times = np.array(times)
+        # each row of W is the distribution of wages with the base pay shifted by inc
+        inc = np.arange(-5, 5, .05)
+        W = (df.pay.values + inc.reshape((-1, 1))) / df.hours.values
+        ok = np.array([np.median(W[:, g], axis=1) > target_wage
+                       for g in df.groupby('study_id', sort=False).indices.values()])
+
+        summary = df.groupby('study_id', sort=False).agg(
+            name=('internal_name', 'first'),
+            n=('pay', 'size'),
+            minutes=('hours', 'median'),
+            pay=('pay', 'median'),
+            wage=('wage', 'median'),
+            basepay=('basepay', 'first'),
+        )
+        summary['minutes'] *= 60
+        summary['adjust'] = inc[ok.argmax(axis=1)].round(2) + 0  # no -0.00
+        summary['new_base'] = summary.basepay + summary.adjust
 
         try:
             import uniplot
-            uniplot.plot(pays, 60*times, x_unit=" min", y_unit=" $", title="Pay by Time")
+            uniplot.plot(df.pay.values, 60*df.hours.values, x_unit=" min", y_unit=" $", title="Pay by Time")
         except ImportError:
             print('pip install uniplot to get a nice plot here')
 
-        print(f'median time is: {60*np.median(times):.2f} minutes')
-        print(f'average pay is: ${np.median(pays):.2f}')
-        print(f'median wage is: ${np.median(pays / times):.2f}/hr')
+        if len(summary) > 1:
+            print(summary.round(2).to_string())
+            print(f'\npooled over {len(summary)} studies ({len(df)} submissions)')
 
-        inc = np.arange(-5, 5, .05).reshape((-1, 1))
-        W = (pays + inc) / times
-        i = np.argmax(np.median(W, axis=1) > target_wage)
+        print(f'median time is: {60*df.hours.median():.2f} minutes')
+        print(f'average pay is: ${df.pay.median():.2f}')
+        print(f'median wage is: ${df.wage.median():.2f}/hr')
 
-        missing_base = round(inc[i][0], 2)
-        new_base = (basepay / 100) + inc[i][0]
-        print(f'base pay is off by ${-missing_base:+.2f}, should be ${new_base:.2f}')
+        i = np.argmax(np.median(W, axis=1) > target_wage)
+        missing_base = round(inc[i], 2)
+        if len(summary) == 1:
+            new_base = summary.basepay.iloc[0] + inc[i]
+            print(f'base pay is off by ${-missing_base:+.2f}, should be ${new_base:.2f}')
+        else:
+            print(f'base pay is off by ${-missing_base:+.2f}')
 
     def add_places(self, study_id, new_total):
         self._request('PATCH', f'/studies/{study_id}/', dict(total_available_places=new_total))
 
+    def clear_cache(self):
+        """Delete all cached study and submission listings"""
+        self.cache.invalidate()
+
+
+def never_sent(e):
+    """Whether a requests exception means we never connected, so the request can't have taken effect."""
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    # e.g. connection refused: requests wraps urllib3's MaxRetryError, whose reason says why
+    reason = getattr(e.args[0], 'reason', None) if isinstance(e, requests.ConnectionError) and e.args else None
+    return isinstance(reason, NewConnectionError)
+
+def retry_after(r):
+    """Seconds to wait according to the Retry-After header, if any."""
+    value = r.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def load_bonuses(bonuses):
+    """Bonuses as a dict, given a dict or a .json or .csv (workerid,bonus_in_dollars; no header) file"""
+    if isinstance(bonuses, str):
+        file = bonuses
+
+        if file.endswith('.json'):
+            with open(file) as f:
+                bonuses = json.load(f)
+
+        if file.endswith('.csv'):
+            import pandas as pd
+            bonuses = dict(pd.read_csv(file, header=None).set_index(0)[1])
+
+    assert isinstance(bonuses, dict)
+    return bonuses
 
 def find_token():
     if os.path.isfile(".prolific_token"):
@@ -442,4 +841,8 @@ def generate_internal_name():
 
 
 if __name__ == '__main__':
-    Fire(Prolific)
\ No newline at end of file
+    try:
+        Fire(Prolific)
+    except ProlificError as e:
+        print(e)
+        exit(1)
\ No newline at end of file
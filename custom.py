@@ -1,10 +1,23 @@
 # this file imports custom routes into the experiment server
 
-from flask import Blueprint, render_template, request, jsonify, Response, abort, current_app, redirect, url_for
+from flask import Blueprint, render_template, request, jsonify, Response, abort, current_app, redirect, url_for, stream_with_context, send_from_directory, safe_join
 from jinja2 import TemplateNotFound
 from functools import wraps
-from sqlalchemy import or_
+from sqlalchemy import or_, func, case, Column, String, Integer, Float, Boolean
+from sqlalchemy.orm import undefer
 from traceback import format_exc
+import os
+import re
+import zlib
+import csv
+import io
+import time
+import datetime
+import random
+import heapq
+import threading
+from collections import deque
+from statistics import median
 
 from psiturk.psiturk_config import PsiturkConfig
 from psiturk.experiment_errors import ExperimentError, InvalidUsage
@@ -12,7 +25,7 @@ from psiturk.user_utils import PsiTurkAuthorization, nocache
 
 # # Database setup
 from psiturk.db import db_session, init_db
-from psiturk.models import Participant
+from psiturk.models import Participant, Base
 from json import dumps, loads
 
 # load the configuration options
@@ -68,10 +81,83 @@ def get_participants(codeversion):
     )
 
 
-@custom_code.route('/data/<codeversion>/<name>', methods=['GET'])
+def iter_participants(codeversion, uniqueids=None, page_size=100):
+    """Like get_participants, but pages through the table by uniqueid.
+
+    Only one page of participants (and their datastrings) is held in memory
+    at a time, and the first rows are available before the query finishes.
+    If uniqueids is given, only those participants are loaded.
+    """
+    query = (
+        Participant
+        .query
+        .filter(Participant.codeversion == codeversion)
+        .options(undefer('datastring'))
+        .order_by(Participant.uniqueid)
+    )
+    if uniqueids is not None:
+        uniqueids = sorted(uniqueids)
+        for i in range(0, len(uniqueids), page_size):
+            yield from query.filter(Participant.uniqueid.in_(uniqueids[i:i+page_size]))
+        return
+
+    last = None
+    while True:
+        page = query if last is None else query.filter(Participant.uniqueid > last)
+        page = page.limit(page_size).all()
+        yield from page
+        if len(page) < page_size:
+            return
+        last = page[-1].uniqueid
+
+
+def datastring_lengths(codeversion):
+    """Maps uniqueid to the length of that participant's datastring.
+
+    psiTurk only ever appends to the datastring, so this serves as a cursor:
+    a participant has new data iff their length differs from the cursor.
+    The lengths are computed by the database; no datastrings are loaded.
+    """
+    rows = (
+        Participant
+        .query
+        .filter(Participant.codeversion == codeversion)
+        .with_entities(Participant.uniqueid, func.length(Participant.datastring))
+    )
+    return {uid: n for uid, n in rows if n is not None}
+
+
+def changed_since(codeversion, cursor):
+    return [uid for uid, n in datastring_lengths(codeversion).items() if cursor.get(uid) != n]
+
+
+def gzip_chunks(chunks):
+    # wbits=31 produces a gzip (rather than raw zlib) stream. We sync-flush
+    # after each chunk so the client gets data as soon as it's ready.
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        yield compressor.compress(chunk.encode()) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+@custom_code.route('/data/<codeversion>/cursor', methods=['GET'])
+@myauth.requires_auth
+@nocache
+def data_cursor(codeversion):
+    # Fetch this *before* downloading so that anything saved during the
+    # download is picked up again by the next incremental request.
+    return jsonify(datastring_lengths(codeversion))
+
+
+@custom_code.route('/data/<codeversion>/<name>', methods=['GET', 'POST'])
 @myauth.requires_auth
 @nocache
 def download_datafiles(codeversion, name):
+    """Download all data for codeversion as csv.
+
+    POST a cursor (as returned by /data/<codeversion>/cursor) as JSON to only
+    get participants whose data has changed since that cursor was taken.
+    """
     contents = {
         "trialdata": lambda p: p.get_trial_data(),
         "eventdata": lambda p: p.get_event_data(),
@@ -81,24 +167,57 @@ def download_datafiles(codeversion, name):
     if name not in contents:
         abort(404)
 
-    query = get_participants(codeversion)
-    data = []
-    for p in query:
-        try:
-            data.append(contents[name](p))
-        except TypeError:
-            current_app.logger.error("Error loading {} for {}".format(name, p))
-            current_app.logger.error(format_exc())
-            
-    # current_app.logger.critical('data %s', data)
-    ret = "".join(data)
-    response = Response(
-        ret,
-        content_type="text/csv",
-        headers={
-            'Content-Disposition': 'attachment;filename=%s.csv' % name
-        })
+    uniqueids = None
+    if request.method == 'POST':
+        uniqueids = changed_since(codeversion, request.get_json(force=True))
+
+    def generate():
+        for p in iter_participants(codeversion, uniqueids):
+            try:
+                data = contents[name](p)
+            except TypeError:
+                current_app.logger.error("Error loading {} for {}".format(name, p))
+                current_app.logger.error(format_exc())
+                continue
+            if data:
+                yield data
+
+    headers = {'Content-Disposition': 'attachment;filename=%s.csv' % name}
+    body = generate()
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        body = gzip_chunks(body)
+        headers['Content-Encoding'] = 'gzip'
+        headers['Vary'] = 'Accept-Encoding'
+
+    return Response(stream_with_context(body), content_type="text/csv", headers=headers)
 
+
+#----------------------------------------------
+# configs
+#----------------------------------------------
+
+CONFIG_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'json')
+HASHED_CONFIG = re.compile(r'\.[0-9a-f]{12}\.json$')
+
+@custom_code.route('/static/json/<path:filename>')
+def static_config(filename):
+    """Serves the experiment configs, using the .br or .gz variants written by
+    generate_configs.py when the browser accepts them. Content-hashed files
+    never change, so browsers may cache them indefinitely.
+    """
+    accept = request.headers.get('Accept-Encoding', '')
+    for encoding, ext in [('br', '.br'), ('gzip', '.gz')]:
+        if encoding in accept and os.path.isfile(safe_join(CONFIG_ROOT, filename + ext)):
+            response = send_from_directory(CONFIG_ROOT, filename + ext, mimetype='application/json')
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(CONFIG_ROOT, filename)
+    response.headers['Vary'] = 'Accept-Encoding'
+    if HASHED_CONFIG.search(filename):
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
     return response
 
 
@@ -146,27 +265,282 @@ def my_password_protected_route():
         abort(404)
 
 #----------------------------------------------
-# example accessing data
+# condition assignment
 #----------------------------------------------
+
+FINISHED = [COMPLETED, SUBMITTED, CREDITED, BONUSED]
+
+class ConditionBalancer(object):
+    """
+    Hands out the least-filled (cond, counterbalance) pair, like psiTurk's
+    get_random_condcount, without loading every participant on each arrival.
+
+    A slot is filled by a participant who finished or who started less than
+    cutoff minutes ago. The counts are loaded from the database with one
+    aggregate query and then kept in memory: a heap gives the least-filled
+    pair in O(log n), and a queue of start times reclaims slots as they time
+    out. The counts are reloaded every `resync` seconds, which picks up
+    completions and assignments made by other server processes.
+    """
+    def __init__(self, codeversion, mode, numconds, numcounts, cutoff, resync=60):
+        self.codeversion = codeversion
+        self.mode = mode
+        self.keys = [(cond, counter) for cond in range(numconds) for counter in range(numcounts)]
+        self.cutoff = cutoff * 60
+        self.resync = resync
+        self.loaded = None
+        self.lock = threading.Lock()
+
+    def load(self, now):
+        counts = dict.fromkeys(self.keys, 0)
+        participants = (
+            Participant.query
+            .filter(Participant.codeversion == self.codeversion)
+            .filter(Participant.mode == self.mode)
+        )
+        finished = (
+            participants
+            .filter(Participant.status.in_(FINISHED))
+            .with_entities(Participant.cond, Participant.counterbalance, func.count())
+            .group_by(Participant.cond, Participant.counterbalance)
+        )
+        for cond, counter, n in finished:
+            if (cond, counter) in counts:
+                counts[cond, counter] += n
+
+        starttime = datetime.datetime.fromtimestamp(now - self.cutoff, datetime.timezone.utc)
+        active = (
+            participants
+            .filter(~Participant.status.in_(FINISHED))
+            .filter(Participant.beginhit > starttime)
+            .with_entities(Participant.cond, Participant.counterbalance, Participant.beginhit)
+            .order_by(Participant.beginhit)
+        )
+        self.pending = deque()
+        for cond, counter, beginhit in active:
+            if (cond, counter) in counts:
+                counts[cond, counter] += 1
+                if beginhit.tzinfo is None:  # psiTurk stores UTC
+                    beginhit = beginhit.replace(tzinfo=datetime.timezone.utc)
+                self.pending.append((beginhit.timestamp() + self.cutoff, (cond, counter)))
+
+        self.counts = counts
+        # ties are broken at random; entries whose count is out of date are skipped
+        self.heap = [(n, random.random(), key) for key, n in counts.items()]
+        heapq.heapify(self.heap)
+        self.loaded = now
+
+    def assign(self):
+        with self.lock:
+            now = time.time()
+            if self.loaded is None or now - self.loaded > self.resync:
+                self.load(now)
+            while self.pending and self.pending[0][0] <= now:
+                _, key = self.pending.popleft()
+                self.counts[key] -= 1
+                heapq.heappush(self.heap, (self.counts[key], random.random(), key))
+
+            while self.heap[0][0] != self.counts[self.heap[0][2]]:
+                heapq.heappop(self.heap)
+            n, _, key = self.heap[0]
+            self.counts[key] = n + 1
+            heapq.heapreplace(self.heap, (n + 1, random.random(), key))
+            self.pending.append((now + self.cutoff, key))
+            return key
+
+
+_balancers = {}
+
+def custom_get_condition(mode):
+    """Used by psiTurk in place of get_random_condcount; returns (cond, counterbalance)."""
+    codeversion = config.get('Task Parameters', 'experiment_code_version')
+    if (codeversion, mode) not in _balancers:
+        _balancers[codeversion, mode] = ConditionBalancer(
+            codeversion, mode,
+            config.getint('Task Parameters', 'num_conds'),
+            config.getint('Task Parameters', 'num_counters'),
+            config.getint('Task Parameters', 'cutoff_time'),
+        )
+    chosen = _balancers[codeversion, mode].assign()
+    current_app.logger.info("chose condition %s", chosen)
+    return chosen
+
+
+#----------------------------------------------
+# monitoring
+#----------------------------------------------
+
+STATUS_NAMES = {
+    NOT_ACCEPTED: 'not accepted', ALLOCATED: 'allocated', STARTED: 'started',
+    COMPLETED: 'completed', SUBMITTED: 'submitted', CREDITED: 'credited',
+    QUITEARLY: 'quit early', BONUSED: 'bonused', BAD: 'bad',
+}
+MONITOR_TTL = 10  # seconds
+
+# key -> (time, value). Several people refreshing during a launch share one query.
+_monitor_cache = {}
+
+def cached(key, compute, ttl=MONITOR_TTL):
+    now = time.time()
+    if key in _monitor_cache and now - _monitor_cache[key][0] < ttl:
+        return _monitor_cache[key][1]
+    for k in [k for k, (t, _) in _monitor_cache.items() if now - t >= ttl]:
+        del _monitor_cache[k]
+    value = compute()
+    _monitor_cache[key] = (now, value)
+    return value
+
+
+def monitor_stats(codeversion):
+    """Counts by status and condition, completion rate, and median durations.
+
+    Everything is aggregated by the database except the medians, which only
+    need the active_minutes column of the participant index.
+    """
+    started = Participant.status >= STARTED
+    completed = Participant.status.in_([COMPLETED, SUBMITTED, CREDITED, BONUSED])
+    by_status = dict(
+        db_session.query(Participant.status, func.count())
+        .filter(Participant.codeversion == codeversion)
+        .group_by(Participant.status)
+    )
+    by_condition = [
+        {'condition': cond, 'n': n, 'started': n_started or 0, 'completed': n_completed or 0}
+        for cond, n, n_started, n_completed in
+        db_session.query(
+            Participant.cond, func.count(),
+            func.sum(case([(started, 1)], else_=0)),
+            func.sum(case([(completed, 1)], else_=0)))
+        .filter(Participant.codeversion == codeversion)
+        .group_by(Participant.cond)
+        .order_by(Participant.cond)
+    ]
+    minutes = sorted(m for m, in
+        db_session.query(ParticipantIndex.active_minutes)
+        .filter(ParticipantIndex.codeversion == codeversion)
+        .filter(ParticipantIndex.complete)
+        .filter(ParticipantIndex.active_minutes.isnot(None))
+    )
+    n_started = sum(c['started'] for c in by_condition)
+    n_completed = sum(c['completed'] for c in by_condition)
+    return {
+        'codeversion': codeversion,
+        'total': sum(by_status.values()),
+        'by_status': {STATUS_NAMES.get(s, s): n for s, n in sorted(by_status.items())},
+        'by_condition': by_condition,
+        'started': n_started,
+        'completed': n_completed,
+        'completion_rate': n_completed / n_started if n_started else None,
+        'median_minutes': median(minutes) if minutes else None,
+    }
+
+
+def monitor_page(codeversion, page, per_page):
+    """The most recent participants, without loading any datastrings."""
+    rows = (
+        db_session.query(
+            Participant.uniqueid, Participant.workerid, Participant.cond, Participant.status,
+            Participant.beginhit, Participant.endhit,
+            ParticipantIndex.n_trials, ParticipantIndex.active_minutes, ParticipantIndex.bonus)
+        .outerjoin(ParticipantIndex, ParticipantIndex.uniqueid == Participant.uniqueid)
+        .filter(Participant.codeversion == codeversion)
+        .order_by(Participant.beginhit.desc(), Participant.uniqueid)
+        .offset((page - 1) * per_page)
+        .limit(per_page)
+    )
+    return [
+        {**row._asdict(), 'status': STATUS_NAMES.get(row.status, row.status),
+         'beginhit': row.beginhit and row.beginhit.isoformat(),
+         'endhit': row.endhit and row.endhit.isoformat()}
+        for row in rows
+    ]
+
+
 @custom_code.route('/view_data')
 @myauth.requires_auth
+@nocache
 def list_my_data():
-    users = Participant.query.all()
+    """Live monitoring for one codeversion (default: the configured one).
+
+    Query parameters: codeversion, page, per_page, and format=json to get
+    the same information as JSON.
+    """
+    codeversion = request.args.get('codeversion', config.get('Task Parameters', 'experiment_code_version'))
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', 50, type=int), 1), 500)
+
+    stats = cached(('stats', codeversion), lambda: monitor_stats(codeversion))
+    participants = cached(('page', codeversion, page, per_page),
+                          lambda: monitor_page(codeversion, page, per_page))
+    if request.args.get('format') == 'json':
+        return jsonify(stats=stats, participants=participants, page=page, per_page=per_page)
     try:
-        return render_template('list.html', participants=users)
+        return render_template('list.html', stats=stats, participants=participants,
+                               page=page, per_page=per_page,
+                               n_pages=max(-(-stats['total'] // per_page), 1))
     except TemplateNotFound:
         abort(404)
 
 #----------------------------------------------
-# example computing bonus
+# computing bonus
 #----------------------------------------------
 
+BONUS_PER_SOLUTION = config.getfloat('Task Parameters', 'bonus_per_solution')  # dollars
+
+def summarize_data(data):
+    """Derived fields for ParticipantIndex from a psiTurk data list, in one pass.
+
+    Instruction puzzles also emit machine.done, so we only count those
+    after experiment.main.
+    """
+    main = complete = False
+    n_trials = n_compositional = n_bespoke = 0
+    for record in data:
+        trial = record['trialdata']
+        if trial['event'] == 'experiment.main':
+            main = True
+        elif trial['event'] == 'experiment.complete':
+            complete = True
+        elif main and trial['event'] == 'machine.done':
+            n_trials += 1
+            if trial.get('solutionType') == 'compositional':
+                n_compositional += 1
+            elif trial.get('solutionType') == 'bespoke':
+                n_bespoke += 1
+    return {
+        'main': main,
+        'complete': complete,
+        'active_minutes': (data[-1]['dateTime'] - data[0]['dateTime']) / 60000 if data else None,
+        'n_trials': n_trials,
+        'n_compositional': n_compositional,
+        'n_bespoke': n_bespoke,
+        'bonus': round(BONUS_PER_SOLUTION * (n_compositional + n_bespoke), 2),
+    }
+
+
+def bonus_from_data(data):
+    """Bonus earned in a psiTurk data list: BONUS_PER_SOLUTION per solved main trial."""
+    return summarize_data(data)['bonus']
+
+
+# uniqueid -> (datastring length, bonus). The datastring is append-only, so
+# an unchanged length means an unchanged bonus.
+_bonus_cache = {}
+
+def participant_bonus(p):
+    n = len(p.datastring or '')
+    if _bonus_cache.get(p.uniqueid, (None,))[0] != n:
+        bonus = bonus_from_data(loads(p.datastring)['data']) if p.datastring else 0
+        _bonus_cache[p.uniqueid] = (n, bonus)
+    return _bonus_cache[p.uniqueid][1]
+
+
 @custom_code.route('/compute_bonus', methods=['GET'])
 def compute_bonus():
     # check that user provided the correct keys
     # errors will not be that gracefull here if being
     # accessed by the Javascrip client
-    if not request.args.has_key('uniqueId'):
+    if 'uniqueId' not in request.args:
         raise ExperimentError('improper_inputs')  # i don't like returning HTML to JSON requests...  maybe should change this
     uniqueId = request.args['uniqueId']
 
@@ -174,20 +548,157 @@ def compute_bonus():
         # lookup user in database
         user = Participant.query.\
                filter(Participant.uniqueid == uniqueId).\
+               options(undefer('datastring')).\
                one()
-        user_data = loads(user.datastring) # load datastring from JSON
-        bonus = 0
-
-        for record in user_data['data']: # for line in data file
-            trial = record['trialdata']
-            if trial['phase']=='TEST':
-                if trial['hit']==True:
-                    bonus += 0.02
-        user.bonus = bonus
+        user.bonus = participant_bonus(user)
         db_session.add(user)
         db_session.commit()
-        resp = {"bonusComputed": "success"}
+        resp = {"bonusComputed": "success", "bonus": user.bonus}
         return jsonify(**resp)
     except:
         abort(404)  # again, bad to display HTML, but...
 
+
+@custom_code.route('/bonus/<codeversion>', methods=['GET'])
+@myauth.requires_auth
+@nocache
+def download_bonuses(codeversion):
+    """Bonuses for codeversion in the workerid,bonus format used by bin/prolific.py assign_bonuses.
+
+    By default this reads Participant.bonus, which is kept up to date by
+    update_index. Pass ?recompute=1 to recompute from the datastrings, e.g.
+    for data saved before the hook existed.
+    """
+    if request.args.get('recompute'):
+        for p in iter_participants(codeversion):
+            p.bonus = participant_bonus(p)
+        db_session.commit()
+
+    rows = (
+        Participant
+        .query
+        .filter(Participant.codeversion == codeversion)
+        .filter(Participant.bonus > 0)
+        .with_entities(Participant.workerid, Participant.bonus)
+    )
+    ret = "".join("{},{:.2f}\n".format(workerid, bonus) for workerid, bonus in rows)
+    return Response(
+        ret,
+        content_type="text/csv",
+        headers={
+            'Content-Disposition': 'attachment;filename=bonus.csv'
+        })
+
+#----------------------------------------------
+# participant index
+#----------------------------------------------
+
+class ParticipantIndex(Base):
+    """
+    Fields derived from Participant.datastring, so they can be queried with
+    SQL without loading the datastrings. Maintained by update_index.
+    """
+    __tablename__ = 'participant_index'
+
+    uniqueid = Column(String(128), primary_key=True)
+    codeversion = Column(String(128), index=True)
+    workerid = Column(String(128))
+    condition = Column(Integer)
+    length = Column(Integer)  # of the datastring this row was computed from
+    main = Column(Boolean)
+    complete = Column(Boolean)
+    active_minutes = Column(Float)
+    n_trials = Column(Integer)
+    n_compositional = Column(Integer)
+    n_bespoke = Column(Integer)
+    bonus = Column(Float)
+
+    def __repr__(self):
+        return "ParticipantIndex(%s, %s, %s)" % (self.uniqueid, self.codeversion, self.length)
+
+
+INDEX_COLUMNS = [c.name for c in ParticipantIndex.__table__.columns]
+
+def index_row(p, length, data):
+    """p can be a Participant or a row with uniqueid, codeversion, workerid, and cond."""
+    return ParticipantIndex(
+        uniqueid=p.uniqueid,
+        codeversion=p.codeversion,
+        workerid=p.workerid,
+        condition=p.cond,
+        length=length,
+        **summarize_data(data)
+    )
+
+
+def refresh_index(codeversion):
+    """Recomputes the index rows that are missing or out of date, e.g. for
+    data saved before update_index existed. Only those datastrings are loaded.
+    """
+    indexed = dict(
+        ParticipantIndex.query
+        .filter(ParticipantIndex.codeversion == codeversion)
+        .with_entities(ParticipantIndex.uniqueid, ParticipantIndex.length)
+    )
+    stale = changed_since(codeversion, indexed)
+    for p in iter_participants(codeversion, stale):
+        db_session.merge(index_row(p, len(p.datastring), loads(p.datastring)['data']))
+    db_session.commit()
+    return len(stale)
+
+
+def update_index(response):
+    """Keeps ParticipantIndex and Participant.bonus up to date as data is saved.
+
+    Registered as an after_request hook on psiTurk's PUT /sync/<uid>. We use
+    the request body, which flask has already parsed, so the datastring is
+    never reloaded from the database.
+    """
+    if request.method != 'PUT' or request.endpoint != 'update' or response.status_code != 200:
+        return response
+    try:
+        uid = request.view_args['uid']
+        p = (
+            db_session.query(
+                Participant.uniqueid, Participant.codeversion, Participant.workerid,
+                Participant.cond, func.length(Participant.datastring).label('length'))
+            .filter(Participant.uniqueid == uid)
+            .one()
+        )
+        row = db_session.merge(index_row(p, p.length, request.get_json()['data']))
+        _bonus_cache.pop(uid, None)
+        Participant.query.filter(Participant.uniqueid == uid).update({'bonus': row.bonus})
+        db_session.commit()
+    except Exception:
+        current_app.logger.error("Error updating index for {}".format(request.path))
+        current_app.logger.error(format_exc())
+        db_session.rollback()
+    return response
+
+
+def init_app(app):
+    app.after_request(update_index)
+
+
+@custom_code.route('/index/<codeversion>', methods=['GET'])
+@myauth.requires_auth
+@nocache
+def download_index(codeversion):
+    """The participant index for codeversion as csv."""
+    refresh_index(codeversion)
+    rows = (
+        ParticipantIndex.query
+        .filter(ParticipantIndex.codeversion == codeversion)
+        .order_by(ParticipantIndex.uniqueid)
+        .with_entities(*ParticipantIndex.__table__.columns)
+    )
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(INDEX_COLUMNS)
+    writer.writerows(rows)
+    return Response(
+        out.getvalue(),
+        content_type="text/csv",
+        headers={
+            'Content-Disposition': 'attachment;filename=index.csv'
+        })
@@ -1,7 +1,10 @@
 import os
+import re
 import random
 import json
 import itertools
+import gzip
+import hashlib
 
 from stimuli import Stimuli, Shapes, Codes
 
@@ -98,21 +101,16 @@ class InformativeTrials:
             
             assert self._check_conditions(manual, task, comp, besp)
 
-            while len(manual) < n_manual:
-                for i in range(1000):
-                    # add one decoy
-                    new_entry = (random.choice(self.tasks), random.choice(['bespoke', 'compositional']))
-                    if new_entry in manual:
-                        continue
-                    manual.append(new_entry)
-                    if self._check_conditions(manual, task, comp, besp):
-                        break
-                    else:
-                        manual.pop()
-                else:
-                    import ipdb; ipdb.set_trace()
-                    raise ValueError(f'failed to find a valid trial of type {besp}-{comp}')
-            
+            decoys = self._admissible_decoys(manual, task, comp)
+            n_decoy = n_manual - len(manual)
+            if n_decoy > len(decoys):
+                raise ValueError(
+                    f'trial type {besp}-{comp} with {n_manual} manual entries is infeasible: '
+                    f'need {n_decoy} decoys but only {len(decoys)} are admissible'
+                )
+            manual.extend(random.sample(decoys, n_decoy))
+            assert self._check_conditions(manual, task, comp, besp)
+
             random.shuffle(manual)
             codes = Codes(self.max_digit, self.code_length)
             concrete_trial = Stimuli(self.shapes, codes).trial(task, manual)
@@ -122,6 +120,27 @@ class InformativeTrials:
         random.shuffle(trials)
         return trials
     
+    def _admissible_decoys(self, manual, task, comp):
+        """All manual entries that can be added without changing the trial type.
+
+        Adding an admissible decoy never changes which parts are covered, so
+        any subset of these can be added together.
+        """
+        a, b = task
+        left = any(x == a and kind == 'compositional' for (x, y), kind in manual)
+        right = any(y == b and kind == 'compositional' for (x, y), kind in manual)
+
+        def admissible(t, kind):
+            if t == task or (t, kind) in manual:
+                return False  # would change bespoke availability or exactness
+            if kind == 'bespoke' or comp in ('exact', 'full'):
+                return True
+            # for partial and none, can't cover a part that isn't already covered
+            x, y = t
+            return (x != a or left) and (y != b or right)
+
+        return [(t, kind) for t in self.tasks for kind in ['bespoke', 'compositional'] if admissible(t, kind)]
+
     def _check_conditions(self, manual, task, target_comp, target_besp):
         besp = 'available' if (task, 'bespoke') in manual else 'unavailable'
         if besp != target_besp:
@@ -140,9 +159,13 @@ class InformativeTrials:
         else:
             return target_comp == 'none'
 
-def generate_config(i):
-    random.seed(i)
-    shapes = Shapes(MAIN_SHAPES)
+def generate_config(i, shapes=None, instruct_shapes=None, seed=0):
+    """Generates config i. Pass preloaded Shapes to avoid re-parsing the shape files."""
+    random.seed(seed + i)
+    if shapes is None:
+        shapes = Shapes(MAIN_SHAPES)
+    if instruct_shapes is None:
+        instruct_shapes = Shapes(INSTRUCT_SHAPES)
     trials = InformativeTrials(shapes, MAX_DIGIT, CODE_LENGTH).generate()
     return {
         'trials': list(trials),
@@ -152,24 +175,226 @@ def generate_config(i):
             'codeLength': CODE_LENGTH,
         },
         'instructions': Stimuli(
-            Shapes(INSTRUCT_SHAPES), 
+            instruct_shapes,
             Codes(MAX_DIGIT, CODE_LENGTH)
         ).wrapper_params()
     }
 
+# Configs are written deduplicated: block strings, which only depend on the
+# shape library, go in a shared table, and each trial lists its codes once
+# (by task and kind) rather than in its solutions and every manual entry. Files are
+# named by content hash so the server can let browsers cache them forever;
+# index.json maps conditions to file names. See unpackConfig in experiment.js.
+
+KINDS = ['compositional', 'bespoke']
+HASHED_FILE = re.compile(r'^(\d+|shared)\.[0-9a-f]{12}\.json(\.gz|\.br)?$')
+
+def shared_table(shapes, instruct_shapes):
+    """Block strings shared by all configs generated from these shape libraries."""
+    shared = {'shapes': {}, 'instructions': {'shapes': {}}}
+    for (task, kind), block in shapes.table.items():
+        shared['shapes'].setdefault(task, {})[kind] = block
+    for (task, kind), block in instruct_shapes.table.items():
+        if kind == 'compositional':
+            shared['instructions']['shapes'][task] = block
+    return shared
+
+def pack_config(config, shared):
+    """Removes everything from config that unpack_config can rebuild from shared and each trial's codes."""
+    trials = []
+    for trial in config['trials']:
+        codes = {}
+        def add_code(task, kind, code):
+            assert codes.setdefault(task, {}).setdefault(kind, code) == code
+        assert trial['blockString'] == shared['shapes'][trial['task']]['compositional']
+        for code, kind in trial['solutions'].items():
+            add_code(trial['task'], kind, code)
+        for entry in trial['manual']:
+            assert entry['blockString'] == shared['shapes'][entry['task']][entry['kind']]
+            add_code(entry['task'], entry['kind'], entry['code'])
+        trials.append({
+            **{k: v for k, v in trial.items() if k not in ('solutions', 'blockString', 'manual')},
+            'codes': codes,
+            'manual': [[entry['task'], entry['kind']] for entry in trial['manual']],
+        })
+    instructions = dict(config['instructions'])
+    assert instructions.pop('shapes') == shared['instructions']['shapes']
+    return {'params': config['params'], 'trials': trials, 'instructions': instructions}
+
+def unpack_config(packed, shared):
+    """Inverse of pack_config."""
+    def unpack_trial(trial):
+        trial = dict(trial)
+        codes = trial.pop('codes')
+        return {
+            **trial,
+            'solutions': {codes[trial['task']][kind]: kind for kind in KINDS},
+            'blockString': shared['shapes'][trial['task']]['compositional'],
+            'manual': [{
+                'task': task,
+                'kind': kind,
+                'compositional': kind == 'compositional',
+                'code': codes[task][kind],
+                'blockString': shared['shapes'][task][kind],
+            } for task, kind in trial['manual']],
+        }
+    return {
+        'trials': [unpack_trial(trial) for trial in packed['trials']],
+        'params': packed['params'],
+        'instructions': {**packed['instructions'], **shared['instructions']},
+    }
+
+def load_config(config_dir, i):
+    """Config i as generate_config returned it, from either a packed or an old-style config_dir."""
+    if not os.path.isfile(f'{config_dir}/index.json'):
+        with open(f'{config_dir}/{i}.json') as f:
+            return json.load(f)
+    with open(f'{config_dir}/index.json') as f:
+        index = json.load(f)
+    with open(f'{config_dir}/{index["configs"][str(i)]}') as f:
+        packed = json.load(f)
+    with open(f'{config_dir}/{index["shared"]}') as f:
+        shared = json.load(f)
+    return unpack_config(packed, shared)
+
+def config_conditions(config_dir):
+    """The conditions with a config in config_dir, packed or old-style."""
+    if os.path.isfile(f'{config_dir}/index.json'):
+        with open(f'{config_dir}/index.json') as f:
+            return sorted(int(i) for i in json.load(f)['configs'])
+    return sorted(int(file[:-5]) for file in os.listdir(config_dir) if re.match(r'^\d+\.json$', file))
+
+def write_catalog(config_dir):
+    """Writes config_dir/catalog.arrow, the design of every main trial by condition and trial index.
+
+    This is an uncompressed Arrow IPC file, so analysis code can memory-map it
+    rather than reloading the configs (see join_catalog in bin/process_data.py).
+    """
+    import pyarrow as pa
+    rows = []
+    for condition in config_conditions(config_dir):
+        for trial_index, trial in enumerate(load_config(config_dir, condition)['trials']):
+            bespoke, compositional, n_manual = trial['trialID'].split('-')
+            codes = {kind: code for code, kind in trial['solutions'].items()}
+            rows.append({
+                'condition': condition,
+                'trial_index': trial_index,
+                'trialID': trial['trialID'],
+                'bespoke': bespoke,
+                'compositional': compositional,
+                'n_manual': int(n_manual),
+                'target': trial['task'],
+                'code_compositional': codes['compositional'],
+                'code_bespoke': codes['bespoke'],
+                'manual': json.dumps([[m['task'], m['kind']] for m in trial['manual']]),
+            })
+    table = pa.table({
+        'condition': pa.array([r['condition'] for r in rows], pa.int32()),
+        'trial_index': pa.array([r['trial_index'] for r in rows], pa.int32()),
+        **{k: pa.array([r[k] for r in rows], pa.string()).dictionary_encode()
+           for k in ['trialID', 'bespoke', 'compositional', 'target']},
+        'n_manual': pa.array([r['n_manual'] for r in rows], pa.int32()),
+        **{k: pa.array([r[k] for r in rows], pa.string())
+           for k in ['code_compositional', 'code_bespoke', 'manual']},
+    })
+    tmp = f'{config_dir}/catalog.arrow.tmp'
+    with pa.OSFile(tmp, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    os.replace(tmp, f'{config_dir}/catalog.arrow')
+    return len(rows)
+
+def write_bytes(file, data):
+    # write to a temporary file first so a crash never leaves a partial file
+    tmp = file + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, file)
+
+def write_json(file, obj):
+    write_bytes(file, json.dumps(obj).encode())
+
+def write_bundle(config_dir, name, obj):
+    """Writes obj to config_dir/<name>.<hash>.json, plus .gz and .br variants. Returns the file name."""
+    data = json.dumps(obj, separators=(',', ':')).encode()
+    file = f'{name}.{hashlib.sha256(data).hexdigest()[:12]}.json'
+    write_bytes(f'{config_dir}/{file}', data)
+    write_bytes(f'{config_dir}/{file}.gz', gzip.compress(data, 9, mtime=0))
+    try:
+        import brotli
+        write_bytes(f'{config_dir}/{file}.br', brotli.compress(data))
+    except ImportError:
+        pass
+    return file
+
+def write_config(i, config_dir, shared, **kws):
+    return write_bundle(config_dir, str(i), pack_config(generate_config(i, **kws), shared))
+
+def write_index(config_dir, shared_file, config_files):
+    write_json(f'{config_dir}/index.json', {
+        'shared': shared_file,
+        'configs': {str(i): file for i, file in enumerate(config_files)},
+    })
+    # remove bundles from previous runs
+    keep = {shared_file, *config_files}
+    for file in os.listdir(config_dir):
+        if HASHED_FILE.match(file) and file.split('.json')[0] + '.json' not in keep:
+            os.remove(f'{config_dir}/{file}')
+
 def test():
     shapes = Shapes(MAIN_SHAPES)
     gen = InformativeTrials(shapes, MAX_DIGIT, CODE_LENGTH)
     assert gen._check_conditions([('12', 'compositional'), ('21', 'compositional')], '22', 'full', 'unavailable')
+    manual = [('21', 'compositional')]
+    for decoy in gen._admissible_decoys(manual, '22', 'partial'):
+        assert gen._check_conditions(manual + [decoy], '22', 'partial', 'unavailable')
+    shared = shared_table(shapes, Shapes(INSTRUCT_SHAPES))
+    config = generate_config(0, shapes)
+    assert unpack_config(json.loads(json.dumps(pack_config(config, shared))), shared) == config
 
 
 if __name__ == '__main__':
+    from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+    from concurrent.futures import ProcessPoolExecutor
+    from functools import partial
+
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-n", "--n-config", help="Number of configs to generate", type=int, default=N_CONFIG)
+    parser.add_argument("-o", "--config-dir", help="Output directory", default=CONFIG_DIR)
+    parser.add_argument("--shapes", help="Shape library for the main trials", default=MAIN_SHAPES)
+    parser.add_argument("--instruct-shapes", help="Shape library for the instructions", default=INSTRUCT_SHAPES)
+    parser.add_argument("--seed", help="Config i is generated with random seed SEED + i", type=int, default=0)
+    parser.add_argument("--jobs", help="Number of processes", type=int, default=1)
+    parser.add_argument("--catalog", help="Only rebuild catalog.arrow for the configs already in config-dir", action="store_true")
+    args = parser.parse_args()
 
-    os.makedirs(CONFIG_DIR, exist_ok=True)
-    for i in range(N_CONFIG):
-        config = generate_config(i)
-        json.dump(config, open(f'{CONFIG_DIR}/{i}.json', 'w'))
-        # print(f'wrote {CONFIG_DIR}/{i}.json')
+    if args.catalog:
+        print(write_catalog(args.config_dir), 'trials in', f'{args.config_dir}/catalog.arrow')
+        exit()
 
-    print(f'wrote {N_CONFIG} configs to {CONFIG_DIR}')
+    os.makedirs(args.config_dir, exist_ok=True)
+    shapes = Shapes(args.shapes)
+    instruct_shapes = Shapes(args.instruct_shapes)
+    shared = shared_table(shapes, instruct_shapes)
+    write = partial(write_config,
+        config_dir=args.config_dir,
+        shared=shared,
+        shapes=shapes,
+        instruct_shapes=instruct_shapes,
+        seed=args.seed,
+    )
+    if args.jobs > 1:
+        with ProcessPoolExecutor(args.jobs) as pool:
+            files = list(pool.map(write, range(args.n_config), chunksize=max(1, args.n_config // (4 * args.jobs))))
+    else:
+        files = list(map(write, range(args.n_config)))
+    write_index(args.config_dir, write_bundle(args.config_dir, 'shared', shared), files)
 
+    try:
+        import brotli
+    except ImportError:
+        print('pip install brotli to also write .br files')
+    try:
+        write_catalog(args.config_dir)
+    except ImportError:
+        print('pip install pyarrow to also write catalog.arrow')
+    print(f'wrote {args.n_config} configs to {args.config_dir}')
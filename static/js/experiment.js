@@ -37,7 +37,7 @@ async function runExperiment() {
     'static/json/test.json' :
     `static/json/${PARAMS.config_dir}/${CONDITION}.json`
   try {
-    config = await $.getJSON(configFile)
+    config = urlParams.test ? await $.getJSON(configFile) : await loadConfig(PARAMS.config_dir, CONDITION)
     console.log(configFile, config)
   } catch(err) {
     console.log("ERR HERE")
@@ -184,3 +184,45 @@ async function runExperiment() {
     debrief
   )
 };
+
+
+// configs written by generate_configs.py are packed: index.json maps each
+// condition to a content-hashed file, and block strings live in a shared file
+async function loadConfig(configDir, condition) {
+  const dir = `static/json/${configDir}`
+  let index
+  try {
+    index = await $.getJSON(`${dir}/index.json`)
+  } catch(err) {
+    return await $.getJSON(`${dir}/${condition}.json`)  // old-style config_dir
+  }
+  const [packed, shared] = await Promise.all([
+    $.getJSON(`${dir}/${index.configs[condition]}`),
+    $.getJSON(`${dir}/${index.shared}`),
+  ])
+  return unpackConfig(packed, shared)
+}
+
+// inverse of pack_config in generate_configs.py
+function unpackConfig(packed, shared) {
+  const trials = packed.trials.map(({codes, ...trial}) => ({
+    ...trial,
+    solutions: {
+      [codes[trial.task].compositional]: 'compositional',
+      [codes[trial.task].bespoke]: 'bespoke',
+    },
+    blockString: shared.shapes[trial.task].compositional,
+    manual: trial.manual.map(([task, kind]) => ({
+      task,
+      kind,
+      compositional: kind == 'compositional',
+      code: codes[task][kind],
+      blockString: shared.shapes[task][kind],
+    })),
+  }))
+  return {
+    trials,
+    params: packed.params,
+    instructions: {...packed.instructions, ...shared.instructions},
+  }
+}
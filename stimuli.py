@@ -2,78 +2,172 @@ from functools import lru_cache
 import json
 import random
 from itertools import product
+import numpy as np
 
 
 class Shapes:
+    """Left and right shape parts, stored as uint8 grids.
+
+    Cells are EMPTY, LEFT, or RIGHT in the parts; composed bespoke shapes use
+    BESPOKE. Grids are only converted to block strings (e.g. "_11\n_22") when
+    they are serialized into a config.
+    """
+    EMPTY, LEFT, RIGHT, BESPOKE = range(4)
+    CHARS = np.frombuffer(b'_123', dtype=np.uint8)
+
     def __init__(self, filepath):
-        self.shapes, (self.width, self.height) = self._parse_shapes(filepath)
-        self.n_part = len(self.shapes['left'])
-    
+        self.parts, (self.width, self.height) = self._parse_shapes(filepath)
+        self.n_part = len(self.parts['left'])
+        self.table = self._build_table()
+
     def get(self, task, kind):
-        a, b = map(lambda x: int(x)-1, task)
-        if kind == 'compositional':
-            return self._compose_block_strings(self.shapes['left'][a], self.shapes['right'][b])
-        else:
-            assert kind == 'bespoke'
-            return self._make_bespoke(self._compose_block_strings(self.shapes['left'][a], self.shapes['right'][b]))
-        
-    
+        assert kind in ('compositional', 'bespoke')
+        return self.table[task, kind]
+
+    def compose_all(self):
+        """All n_part x n_part compositions as a (left, right, height, width) array"""
+        return self.compose(self.parts['left'][:, None], self.parts['right'][None, :])
+
+    def _build_table(self):
+        """Maps (task, kind) to a block string for every task.
+
+        Everything is composed at load time so that an invalid shape library
+        fails here rather than partway through generating a config.
+        """
+        try:
+            grids = self.compose_all()
+        except ValueError:
+            # find the offending pair for the error message
+            for a, b in product(range(self.n_part), repeat=2):
+                try:
+                    self.compose(self.parts['left'][a], self.parts['right'][b])
+                except ValueError as e:
+                    raise ValueError(f"Can't compose left part {a+1} with right part {b+1}. {e}") from None
+            raise
+        bespoke = self._make_bespoke(grids)
+
+        table = {}
+        for a, b in product(range(self.n_part), repeat=2):
+            task = f"{a+1}{b+1}"
+            table[task, 'compositional'] = self.to_block_string(grids[a, b])
+            table[task, 'bespoke'] = self.to_block_string(bespoke[a, b])
+        return table
+
     @staticmethod
     def _parse_shapes(filepath):
         with open(filepath, 'r') as file:
             raw_shapes = json.load(file)
 
-        def to_block_string(shape):
+        def to_grids(shapes):
+            x = np.array(shapes)
+            grids = np.where(x == 1, Shapes.LEFT, np.where(x == 2, Shapes.RIGHT, Shapes.EMPTY)).astype(np.uint8)
             padding = raw_shapes.get('padding', {})
-            trimmed = [row[padding.get('left', 0):-padding.get('right', 0)] if padding else row for row in shape]
-            return '\n'.join(''.join('1' if x == 1 else '2' if x == 2 else '_' for x in row) for row in trimmed)
-        shapes = {
-            'left': [to_block_string(shape) for shape in raw_shapes['left']],
-            'right': [to_block_string(shape) for shape in raw_shapes['right']]
+            return grids[:, :, padding.get('left', 0):grids.shape[2] - padding.get('right', 0)]
+
+        parts = {
+            'left': to_grids(raw_shapes['left']),
+            'right': to_grids(raw_shapes['right'])
         }
         size = (len(raw_shapes['left'][0][0]), len(raw_shapes['left'][0]))
-        return shapes, size
+        return parts, size
+
+    @staticmethod
+    def compose(left, right):
+        """Overlays left and right part grids (broadcasting over leading axes)."""
+        if left.shape[-2:] != right.shape[-2:]:
+            raise ValueError("Left and right shapes must be the same size")
+
+        is_left = left == Shapes.LEFT
+        is_right = right == Shapes.RIGHT
+        if (is_left & is_right).any():
+            raise ValueError("Conflict: left is '1' and right is '2'")
+        if not (is_left | is_right | ((left == Shapes.EMPTY) & (right == Shapes.EMPTY))).all():
+            raise ValueError("Unexpected combination: left parts may only contain '1' and right parts '2'")
+
+        return np.where(is_left, Shapes.LEFT, np.where(is_right, Shapes.RIGHT, Shapes.EMPTY)).astype(np.uint8)
 
     @staticmethod
-    def _compose_block_strings(left, right):
-        if len(left) != len(right):
-            raise ValueError("Left and right strings must be of equal length")
-
-        result = []
-        for l, r in zip(left, right):
-            if l == '\n' and r == '\n':
-                result.append('\n')
-            elif l == '1' and r == '2':
-                raise ValueError("Conflict: left is '1' and right is '2'")
-            elif l == '1':
-                result.append('1')
-            elif r == '2':
-                result.append('2')
-            elif l == '_' and r == '_':
-                result.append('_')
-            elif l != '\n' and r != '\n':
-                raise ValueError(f"Unexpected combination: left='{l}', right='{r}'")
-            else:
-                raise ValueError(f"Misaligned newlines: left='{l}', right='{r}'")
-
-        return ''.join(result)
+    def _make_bespoke(grid):
+        return np.where(grid != Shapes.EMPTY, Shapes.BESPOKE, Shapes.EMPTY).astype(np.uint8)
 
     @staticmethod
-    def _make_bespoke(blockString):
-        return blockString.replace('1', '3').replace('2', '3')
+    def to_block_string(grid):
+        chars = Shapes.CHARS[grid]
+        newlines = np.full((grid.shape[0], 1), ord('\n'), dtype=np.uint8)
+        return np.hstack([chars, newlines]).tobytes().decode()[:-1]
+
+
+class CodeSpace:
+    """All codes of a given length, in a random order that is computed lazily.
+
+    Codes are identified with integers in range(max_digit ** length), read as
+    base-max_digit numbers with digits shifted up by one. The order is given
+    by a random bijection on that range (a small Feistel network with cycle
+    walking), so iterating over the codes takes O(1) memory.
+    """
+    MASK64 = (1 << 64) - 1
+
+    def __init__(self, max_digit, length, rounds=6):
+        self.max_digit = max_digit
+        self.length = length
+        self.size = max_digit ** length
+        self.half_bits = max(1, ((self.size - 1).bit_length() + 1) // 2)
+        self.keys = [random.getrandbits(64) for _ in range(rounds)]
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return map(self.permute, range(self.size))
+
+    def permute(self, i):
+        """The i-th integer in the random order"""
+        x = self._feistel(i)
+        while x >= self.size:  # the Feistel domain is < 4x larger, so this is short
+            x = self._feistel(x)
+        return x
+
+    def code(self, x):
+        digits = []
+        for _ in range(self.length):
+            x, d = divmod(x, self.max_digit)
+            digits.append(str(d + 1))
+        return ''.join(reversed(digits))
+
+    def index(self, code):
+        x = 0
+        for d in code:
+            x = x * self.max_digit + int(d) - 1
+        return x
+
+    def _feistel(self, x):
+        mask = (1 << self.half_bits) - 1
+        left, right = x >> self.half_bits, x & mask
+        for key in self.keys:
+            left, right = right, left ^ (self._mix(right ^ key) & mask)
+        return (left << self.half_bits) | right
+
+    @classmethod
+    def _mix(cls, x):
+        # splitmix64 finalizer
+        x = (x ^ (x >> 30)) * 0xBF58476D1CE4E5B9 & cls.MASK64
+        x = (x ^ (x >> 27)) * 0x94D049BB133111EB & cls.MASK64
+        return x ^ (x >> 31)
 
 
 class Codes:
     def __init__(self, max_digit, code_length):
         self.max_digit = max_digit
         self.code_length = code_length
-        self._part_codes = self._code_iterator(self.code_length // 2, self.max_digit)
-        self._full_codes = self._code_iterator(self.code_length, self.max_digit)
+        self._part_space = CodeSpace(self.max_digit, self.code_length // 2)
+        self._full_space = CodeSpace(self.max_digit, self.code_length)
+        self._part_codes = iter(self._part_space)
+        self._full_codes = iter(self._full_space)
 
     @lru_cache(maxsize=None)
     def get(self, task, kind):
         if len(task) == 1:
-            return next(self._part_codes)
+            return self._part_space.code(next(self._part_codes))
         else:
             assert len(task) == 2
         
@@ -82,15 +176,16 @@ class Codes:
             return self.get(a, 'left') + self.get(b, 'right')
         else:
             assert kind == 'bespoke'
-            code = next(code for code in self._full_codes if 
-                        not code.startswith(self.get(a, 'left')) and
-                        not code.endswith(self.get(b, 'right')))
-            return code
-        
-    def _code_iterator(self, length, max_digit):
-        codes = [''.join(str(x) for x in code) for code in product(range(1, max_digit+1), repeat=length)]
-        random.shuffle(codes)
-        yield from codes
+            # Part codes have code_length // 2 digits, so a full code x starts
+            # with the left code iff x // max_digit ** (code_length - code_length // 2)
+            # == left, and ends with the right code iff x % n_part == right.
+            # The two differ when code_length is odd.
+            n_part = self.max_digit ** (self.code_length // 2)
+            n_rest = self.max_digit ** (self.code_length - self.code_length // 2)
+            left = self._part_space.index(self.get(a, 'left'))
+            right = self._part_space.index(self.get(b, 'right'))
+            x = next(x for x in self._full_codes if x // n_rest != left and x % n_part != right)
+            return self._full_space.code(x)
 
 
 class Stimuli: